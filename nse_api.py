@@ -3,11 +3,15 @@ import os
 import logging
 import traceback
 import asyncio
+import json
+import time
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from nse_engine import NSEKnowledgeBase
+from nse_engine import NSEKnowledgeBase, RefreshCoordinator
+from nse_worker import make_coordinator, make_cache_backend, check_shared_data_dir
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -18,28 +22,37 @@ logger = logging.getLogger("NSE-API")
 
 # --- Global State ---
 nse_engine = None
+refresh_coordinator = None
 
 # --- Lifespan Manager (Startup/Shutdown) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global nse_engine
+    global nse_engine, refresh_coordinator
     api_key = os.getenv("OPENAI_API_KEY")
     pinecone_key = os.getenv("PINECONE_API_KEY")
+    # Refuse to start against a different data directory than the worker's
+    check_shared_data_dir()
 
     if api_key and pinecone_key:
         try:
             logger.info("Initializing NSE Knowledge Base...")
             # Initialize engine in a thread to avoid blocking startup
-            nse_engine = await asyncio.to_thread(NSEKnowledgeBase, api_key, pinecone_key)
+            # Share the answer cache across workers when Redis is configured
+            nse_engine = await asyncio.to_thread(NSEKnowledgeBase, api_key, pinecone_key, make_cache_backend())
             logger.info("NSE Engine Initialized Successfully.")
         except Exception as e:
             logger.error(f"Failed to initialize engine: {e}")
             logger.error(traceback.format_exc())
     else:
         logger.warning("CRITICAL: API keys not found in environment variables.")
+
+    # The API only enqueues refreshes; the ingestion worker (python -m nse_worker) runs them
+    refresh_coordinator = make_coordinator()
     
     yield
     logger.info("Shutting down NSE API.")
+    if nse_engine:
+        await nse_engine.aclose()
 
 # --- App Definition ---
 app = FastAPI(title="NSE Assistant API", lifespan=lifespan)
@@ -70,42 +83,93 @@ async def ask_question(request: QueryRequest):
         raise HTTPException(status_code=503, detail="Engine not initialized (Check Keys)")
         
     try:
-        # Offload heavy blocking logic to thread
-        response = await asyncio.to_thread(get_answer_sync, request.query)
-        return response
+        return await get_answer(request.query)
 
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
-def get_answer_sync(query):
-    stream, sources = nse_engine.answer_question(query)
+async def get_answer(query):
+    stream, sources = await nse_engine.answer_question_async(query)
     full_response = ""
-    if hasattr(stream, '__iter__') and not isinstance(stream, str):
-        for chunk in stream:
-            if chunk.choices[0].delta.content:
+    if hasattr(stream, '__aiter__'):
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
                 full_response += chunk.choices[0].delta.content
     else:
         full_response = str(stream)
     return {"answer": full_response, "sources": sources}
 
-@app.post("/refresh")
-def trigger_refresh(background_tasks: BackgroundTasks):
+@app.post("/ask/stream")
+async def ask_question_stream(request: QueryRequest):
     if not nse_engine:
-        raise HTTPException(status_code=503, detail="Engine not initialized")
+        raise HTTPException(status_code=503, detail="Engine not initialized (Check Keys)")
 
-    def run_update_task():
-        logger.info("Starting background knowledge base refresh...")
-        try:
-            msg, _ = nse_engine.build_knowledge_base()
-            logger.info(f"Refresh complete: {msg}")
-        except Exception as e:
-            logger.error(f"Refresh failed: {e}")
-            logger.error(traceback.format_exc())
+    return StreamingResponse(
+        stream_answer_events(request.query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_answer_events(query):
+    """Yields SSE events: `sources` first, then `token` deltas, then `done` with timing and usage."""
+    started = time.perf_counter()
+    first_token_at = None
+    usage = None
+    try:
+        stream, sources = await nse_engine.answer_question_async(query)
+        yield sse_event("sources", {"sources": sources})
+
+        if isinstance(stream, str):
+            first_token_at = time.perf_counter()
+            yield sse_event("token", {"delta": stream})
+        else:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage.model_dump()
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    yield sse_event("token", {"delta": chunk.choices[0].delta.content})
+    except Exception as e:
+        logger.error(f"Error streaming query: {e}")
+        logger.error(traceback.format_exc())
+        yield sse_event("error", {"detail": str(e)})
+        return
+
+    finished = time.perf_counter()
+    yield sse_event("done", {
+        "timing": {
+            "time_to_first_token_ms": round((first_token_at - started) * 1000, 1) if first_token_at else None,
+            "total_ms": round((finished - started) * 1000, 1),
+        },
+        "usage": usage,
+    })
+
+@app.post("/refresh")
+def trigger_refresh(force: bool = False):
+    job, created = refresh_coordinator.trigger(force=force)
+    if not created:
+        message = "Refresh already in progress." if job["status"] in RefreshCoordinator.ACTIVE else "Knowledge base is fresh; refresh skipped."
+        return {"job_id": job["id"], "status": job["status"], "created": False, "message": message}
+
+    logger.info(f"Queued knowledge base refresh {job['id']}.")
+    return {"job_id": job["id"], "status": job["status"], "created": True, "message": "Knowledge base refresh queued for the ingestion worker."}
+
+@app.get("/refresh/status")
+def refresh_status():
+    return refresh_coordinator.status()
 
-    background_tasks.add_task(run_update_task)
-    return {"message": "Knowledge base refresh started in background."}
+@app.get("/refresh/{job_id}")
+def refresh_job(job_id: str):
+    job = refresh_coordinator.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Unknown refresh job")
+    return job
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
@@ -1,22 +1,33 @@
 import os
+import asyncio
 import requests
 from bs4 import BeautifulSoup
 from pinecone import Pinecone, ServerlessSpec
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, BadRequestError
 import uuid
 import urllib3
 import concurrent.futures
+import multiprocessing
 import time
 import io
 import re
 import random
+import itertools
 import datetime
 import hashlib
+import json
+import sqlite3
+import threading
+import queue
+import numpy as np
+from xml.etree import ElementTree
+import httpx
+import tiktoken
 from pypdf import PdfReader
-from urllib.parse import urljoin, urlparse
-from tenacity import retry, stop_after_attempt, wait_fixed
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_not_exception_type
 from rank_bm25 import BM25Okapi
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict, deque
 
 # Suppress SSL warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -26,16 +37,1300 @@ EMBEDDING_MODEL = "text-embedding-3-small"
 LLM_MODEL = "gpt-4o-mini"
 MAX_CRAWL_DEPTH = 3
 MAX_PAGES_TO_CRAWL = 1000
+CRAWL_DOMAIN = "nse.co.ke"
+CRAWL_CONCURRENCY = 16
+CRAWL_PER_HOST_CONCURRENCY = 4
+CRAWL_POLITENESS_DELAY_SECONDS = 0.1  # minimum gap between request starts to the same host
+# Frontier ranking, lower is fetched first: each level of depth costs, valuable sections and PDFs earn credit.
+CRAWL_PRIORITY_WEIGHTS = {"depth": 10, "seed_section": -5, "dataservices": -20, "pdf": -10, "recent": -8, "old_year": 5}
+CRAWL_RECENT_SECONDS = 30 * 24 * 3600
+# The site answers on both nse.co.ke and www.nse.co.ke, over http and https; one form is canonical.
+CANONICAL_HOSTS = {"nse.co.ke": "www.nse.co.ke", "www.nse.co.ke": "www.nse.co.ke"}
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid", "_ga", "_gl")
+# Discovery: WordPress publishes its URLs (with last-modified times) in sitemaps and REST listings,
+# so the crawl can enumerate the site up front and only link-follow for what those miss.
+SITEMAP_PATHS = ("/sitemap.xml", "/sitemap_index.xml", "/wp-sitemap.xml")
+SITEMAP_MAX_FILES = 50
+DISCOVERY_USE_WP_REST = True
+WP_REST_ENDPOINTS = (("/wp-json/wp/v2/pages", "link"), ("/wp-json/wp/v2/posts", "link"), ("/wp-json/wp/v2/media", "source_url"))
+WP_REST_MAX_PAGES = 20
 PINECONE_INDEX_NAME = "nse-data"
 PINECONE_DIMENSION = 1536 
+FACT_SECTION_MAX_CHARS = 4000
+FACT_CONTEXT_TOP_K = 6
+CHUNK_CONTEXT_TOP_K = 10
+CONTEXT_TOKEN_BUDGET = 4000
+EMBED_BATCH_MAX_TOKENS = 100000
+EMBED_BATCH_MAX_INPUTS = 512
+EMBED_MAX_IN_FLIGHT = 4
+EMBED_BATCH_LINGER_SECONDS = 0.25
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_FETCH_WORKERS = 8
+# Parsing runs in worker processes, one core left for fetching and embedding; each parse thread feeds one process.
+PARSE_PROCESSES = max(1, (os.cpu_count() or 2) - 1)
+PIPELINE_PARSE_WORKERS = PARSE_PROCESSES
+PIPELINE_EMBED_WORKERS = 8
+PIPELINE_UPSERT_WORKERS = 1
+# Pinecone rejects upsert requests over 2MB or 1000 vectors; batches are packed below that with headroom.
+UPSERT_MAX_REQUEST_BYTES = 2 * 1024 * 1024
+UPSERT_TARGET_BYTES = 1500000
+UPSERT_MAX_VECTORS = 1000
+UPSERT_WORKERS = 4
+UPSERT_MAX_RETRIES = 5
+UPSERT_BACKOFF_SECONDS = 1.0
+# Refresh jobs: triggers inside the freshness window reuse the last finished job, and a running job
+# whose heartbeat is older than the lease is treated as abandoned (its worker died).
+REFRESH_FRESHNESS_SECONDS = 6 * 3600
+REFRESH_LEASE_SECONDS = 120
+REFRESH_HEARTBEAT_SECONDS = 15
+# Scheduled refreshes: market data pages are re-checked every few minutes while the market is open,
+# other HTML daily and PDFs weekly. A full crawl runs daily to discover new pages.
+SCHEDULER_TICK_SECONDS = 60
+FULL_REFRESH_SECONDS = 24 * 3600
+MARKET_REFRESH_SECONDS = 5 * 60
+HTML_REFRESH_SECONDS = 24 * 3600
+PDF_REFRESH_SECONDS = 7 * 24 * 3600
+MARKET_DATA_PATHS = ("/dataservices/market-statistics", "/dataservices/end-of-day-data", "/dataservices/real-time-data", "/dataservices/market-data-overview")
+MARKET_TZ = datetime.timezone(datetime.timedelta(hours=3))  # Nairobi, no DST
+MARKET_OPEN = datetime.time(9, 30)
+MARKET_CLOSE = datetime.time(15, 0)
+DELETE_BATCH_SIZE = 1000
+STALE_SWEEP_MAX_FRACTION = 0.5
+# Local SQLite state the API reads and the ingestion worker writes; both processes must see the same directory.
+DATA_DIR = os.getenv("NSE_DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_CACHE_PATH = os.path.join(DATA_DIR, "nse_embedding_cache.sqlite3")
+MANIFEST_PATH = os.path.join(DATA_DIR, "nse_manifest.sqlite3")
+KEYWORD_INDEX_PATH = os.path.join(DATA_DIR, "nse_keyword_index.sqlite3")
+JOBS_PATH = os.path.join(DATA_DIR, "nse_jobs.sqlite3")
+DATA_DIR_ID_PATH = os.path.join(DATA_DIR, "nse_data_dir.id")
+RETRIEVAL_TOP_K = 15
+RRF_K = 60
+REWRITE_DEADLINE_SECONDS = 1.5
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 500
+SEMANTIC_CACHE_TTL_SECONDS = 6 * 3600
+NO_ANSWER_MARKER = "My apologies. I cannot find that specific info."
+
+ListedCompany = namedtuple("ListedCompany", ["name", "ticker", "segment", "aliases", "pattern"])
+TickBand = namedtuple("TickBand", ["market", "low", "label", "tick"])
+FeeRate = namedtuple("FeeRate", ["product", "participant", "rate"])
+TradingSession = namedtuple("TradingSession", ["name", "hours"])
+
+FEE_PRODUCTS = {
+    "OFFICIAL_NSE_10_SHARE_INDEX_FUTURES_RULES_V2": "NSE 10 Share Index Futures",
+    "OFFICIAL_NSE_SINGLE_STOCK_FUTURES_RULES_V2": "Single Stock Futures",
+    "OFFICIAL_NSE_OPTIONS_ON_FUTURES_RULES_V1": "Options on Futures",
+}
+NAME_SUFFIXES = {"plc", "ltd", "limited", "company", "group", "holdings", "corporation", "kenya", "of", "the"}
+DERIVATIVE_WORDS = ("future", "derivative", "option", "next ")
+
+
+_encoders = {}
+
+def count_tokens(text, model=LLM_MODEL):
+    # Falls back to a 4-chars-per-token estimate if the encoding can't be loaded.
+    if model not in _encoders:
+        try:
+            _encoders[model] = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            print(f"Tokenizer unavailable for {model}: {e}")
+            _encoders[model] = None
+    encoder = _encoders[model]
+    if encoder is None: return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+_STOP = object()
+
+def extract_pdf_text(pdf_bytes):
+    try:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        return "".join(page.extract_text() or "" for page in reader.pages), len(reader.pages)
+    except:
+        return "", 0
+
+
+def parse_document(url, ctype, content):
+    """Extracts tagged text from raw HTML or PDF bytes. Runs in the parse process pool, so it must stay top-level."""
+    tag = "[GENERAL]"
+    if "statistics" in url: tag = "[MARKET_DATA]"
+    if ctype == "pdf":
+        text, pages = extract_pdf_text(content)
+    else:
+        soup = BeautifulSoup(content, 'html.parser')
+        text, pages = soup.get_text(separator="\n"), 1
+    return f"{tag} SOURCE: {url}\n\n{text.strip()}", pages
+
+
+def canonicalize_url(url):
+    """One spelling per document: no fragment or tracking parameters, sorted query, lowercase host,
+    https on the NSE host, and a trailing slash on page paths (WordPress's own canonical form)."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if host in CANONICAL_HOSTS:
+        scheme, host, port = "https", CANONICAL_HOSTS[host], None
+    if port and (scheme, port) not in (("http", 80), ("https", 443)): host = f"{host}:{port}"
+    path = parts.path or "/"
+    if not path.endswith("/") and "." not in path.rsplit("/", 1)[-1]: path += "/"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith(TRACKING_PARAMS))
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+def parse_lastmod(value):
+    # Sitemap <lastmod> is W3C datetime (date-only allowed); WP REST modified_gmt has no offset. Both are UTC.
+    if not value: return None
+    try:
+        dt = datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def in_domain(url, domain):
+    # Host match, not substring: "nse.co.ke.example.com" or "?ref=nse.co.ke" are off-site.
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"): return False
+    host = (parts.hostname or "").lower()
+    return host == domain or host.endswith("." + domain) or parts.netloc.lower() == domain
+
+
+def ensure_columns(conn, table, columns):
+    # Adds columns introduced after a store was first created.
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in existing: conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def run_pipeline(items, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    """Streams items through (name, fn, workers) stages joined by bounded queues.
+
+    Each fn takes one item and returns the item for the next stage, or None to drop it.
+    Stages shut down in order, so every item in flight is drained before the next stage stops.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def worker(name, fn, in_q, out_q):
+        while True:
+            item = in_q.get()
+            if item is _STOP: return
+            try:
+                result = fn(item)
+            except Exception as e:
+                print(f"Pipeline {name} error: {e}")
+                continue
+            if result is not None and out_q is not None: out_q.put(result)
+
+    stage_threads = []
+    for i, (name, fn, workers) in enumerate(stages):
+        out_q = queues[i + 1] if i + 1 < len(stages) else None
+        threads = [threading.Thread(target=worker, args=(name, fn, queues[i], out_q), daemon=True) for _ in range(workers)]
+        for t in threads: t.start()
+        stage_threads.append(threads)
+
+    for item in items: queues[0].put(item)
+    for i, threads in enumerate(stage_threads):
+        for _ in threads: queues[i].put(_STOP)
+        for t in threads: t.join()
+
+
+# A direct answer is only given when the question asks one thing and stays inside what the table covers.
+FACT_LOOKUP_CONJUNCTIONS = re.compile(r"\b(and|also|plus|as well as|along with|together with)\b|[;&]|\?.*\S.*\?")
+FACT_LOOKUP_OUT_OF_SCOPE = {
+    # Beyond a name-to-code lookup: market data, advice or opinion, and other companies related to the one named.
+    "ticker": re.compile(
+        r"\b(price|prices|dividends?|market cap\w*|earnings|results|volumes?|performance"
+        r"|buy|sell|good|bad|best|invest\w*|should|worth|recommend\w*"
+        r"|parent|subsidiar(?:y|ies)|owners?|own(?:s|ed)|holding compan(?:y|ies)|sister|affiliates?)\b"
+    ),
+    "tick_size": re.compile(r"\b(bonds?|fixed income|treasury|t-bills?|etfs?|reits?|warrants?|options?|currenc\w+)\b"),
+    "fees": re.compile(r"\b(commissions?|brokers?|brokerage|equit(?:y|ies)|shares|bonds?|cds|account)\b"),
+    "sessions": re.compile(r"\b(holidays?|weekends?|saturdays?|sundays?|christmas|easter|today|tomorrow|now|currently)\b"),
+}
+
+
+class FactLookup:
+    """Typed tables parsed from the fact sheet, answered without the LLM."""
+
+    def __init__(self, sections):
+        self.sources = {}
+        self.companies = []
+        self.tick_bands = []
+        self.fees = []
+        self.sessions = []
+        self.company_source = None
+        self.session_source = None
+        for name, text in sections.items():
+            source = re.search(r"SOURCE:.*?(https?://\S+)", text)
+            self.sources[name] = source.group(1) if source else None
+            if name.startswith("OFFICIAL_NSE_LISTED_COMPANIES"): self._parse_companies(name, text)
+            if name in FEE_PRODUCTS: self._parse_fees(name, text)
+            if name == "OFFICIAL_FACT_SHEET": self._parse_sessions(name, text)
+            self._parse_tick_tables(text)
+
+    # --- PARSERS ---
+    def _parse_companies(self, section, text):
+        segment, seen = None, set()
+        for line in text.split("\n"):
+            line = line.strip()
+            if line.isupper() and not line[:1].isdigit():
+                segment = line.split("(")[0].split("–")[0].strip().title()
+                continue
+            m = re.match(r"^\d+\.\s+(.+?)\s+[–-]\s+([A-Z][A-Z0-9]{1,9})$", line)
+            if not m or m.group(2) in seen: continue
+            seen.add(m.group(2))
+            name = m.group(1)
+            aliases = self._company_aliases(name)
+            pattern = re.compile(r"(?<![a-z0-9])(" + "|".join(re.escape(a) for a in aliases) + r")(?![a-z0-9])")
+            self.companies.append(ListedCompany(name, m.group(2), segment, aliases, pattern))
+        self.company_source = section
+
+    def _company_aliases(self, name):
+        aliases = {name.lower()}
+        aliases.update(p.lower().strip() for p in re.findall(r"\(([^)]+)\)", name))
+        words = re.sub(r"\([^)]*\)", "", name).lower().split()
+        while words and words[-1].strip(".") in NAME_SUFFIXES: words.pop()
+        while words and words[0] == "the": words.pop(0)
+        if words: aliases.add(" ".join(words))
+        if len(words) >= 3: aliases.add(" ".join(words[:2]))
+        return tuple(sorted((a for a in aliases if len(a) >= 3), key=len, reverse=True))
+
+    def _parse_fees(self, section, text):
+        for m in re.finditer(r"^\|\s*([A-Za-z][A-Za-z ]+?)\s*\|\s*([\d.]+%)\s*\|", text, re.M):
+            self.fees.append(FeeRate(FEE_PRODUCTS[section], m.group(1), m.group(2)))
+
+    def _parse_sessions(self, section, text):
+        block = text.split("Trading Hours:", 1)[-1]
+        for m in re.finditer(r"^\s*-\s*([A-Za-z -]+?Session|Continuous Trading):\s*(.+)$", block, re.M):
+            if any(s.name.lower() == m.group(1).lower() for s in self.sessions): continue
+            self.sessions.append(TradingSession(m.group(1), m.group(2).strip()))
+        self.session_source = section
+
+    def _parse_tick_tables(self, text):
+        for header in re.finditer(r"^.*Price Range.*\|\s*Tick Size.*$", text, re.M):
+            preceding = text[max(0, header.start() - 1500):header.start()].lower()
+            market = "derivatives" if "futures" in preceding or "contract size" in preceding else "equity"
+            if any(b.market == market for b in self.tick_bands): continue
+            for line in text[header.end():].lstrip("\n").split("\n"):
+                cells = [c.strip() for c in line.strip().strip("|").split("|")]
+                if len(cells) != 2: break
+                if set(cells[0]) <= set("-: "): continue
+                numbers = [float(n.replace(",", "")) for n in re.findall(r"\d[\d,]*\.?\d*", cells[0])]
+                if not numbers: break
+                low = 0.0 if re.match(r"(?i)below|<", cells[0]) else numbers[0]
+                self.tick_bands.append(TickBand(market, low, cells[0], float(cells[1])))
+
+    # --- QUERY LAYER ---
+    def _find_company(self, query):
+        q = query.lower()
+        best = None
+        for c in self.companies:
+            m = c.pattern.search(q)
+            if m and (not best or len(m.group(1)) > best[1]): best = (c, len(m.group(1)))
+        if best: return best[0]
+        for c in self.companies:
+            if re.search(r"\b" + re.escape(c.ticker) + r"\b", query): return c
+        return None
+
+    def _answer_ticker(self, query):
+        company = self._find_company(query)
+        if not company: return None
+        segment = f" ({company.segment})" if company.segment else ""
+        answer = f"{company.name} trades on the NSE under the ticker **{company.ticker}**{segment}."
+        return answer, self.company_source
+
+    def _answer_tick_size(self, query):
+        q = query.lower()
+        market = "derivatives" if any(w in q for w in DERIVATIVE_WORDS) else "equity"
+        bands = [b for b in self.tick_bands if b.market == market]
+        if not bands: return None
+        label = "single stock futures" if market == "derivatives" else "equities"
+        price = re.search(r"(?:kes|kshs?\.?|sh\.?)\s*([\d,]+(?:\.\d+)?)|([\d,]+(?:\.\d+)?)\s*(?:kes|shillings|bob)", q)
+        if price:
+            value = float((price.group(1) or price.group(2)).replace(",", ""))
+            band = [b for b in bands if b.low <= value][-1]
+            return f"The tick size for {label} priced at KES {value:,.2f} (band: {band.label}) is **KES {band.tick:.2f}**.", None
+        rows = "\n".join(f"- {b.label}: KES {b.tick:.2f}" for b in bands)
+        return f"Tick sizes (minimum price movement) for {label}:\n{rows}", None
+
+    def _answer_fees(self, query):
+        q = query.lower()
+        if "option" in q: product = "Options on Futures"
+        elif "single stock" in q or "stock future" in q: product = "Single Stock Futures"
+        elif "index future" in q or "nse 10" in q or "nse10" in q: product = "NSE 10 Share Index Futures"
+        else: return None
+        rows = [f for f in self.fees if f.product == product]
+        if not rows: return None
+        section = [k for k, v in FEE_PRODUCTS.items() if v == product][0]
+        named = [f for f in rows if f.participant.lower() != "total" and f.participant.lower() in q]
+        if named:
+            labels = [f.participant if re.search(r"(?i)fee|levy", f.participant) else f"{f.participant} fee" for f in named]
+            return " ".join(f"The {label} on {product} is **{f.rate}** of notional contract value." for label, f in zip(labels, named)), section
+        table = "\n".join(f"| {f.participant} | {f.rate} |" for f in rows)
+        return f"Market fees for {product} (as a percentage of notional contract value):\n\n| Participant | Percentage |\n|---|---|\n{table}", section
+
+    def _answer_sessions(self, query):
+        if not self.sessions: return None
+        rows = "\n".join(f"- {s.name}: {s.hours}" for s in self.sessions)
+        return f"NSE equity trading hours (Monday - Friday, excluding public holidays):\n{rows}", self.session_source
+
+    def _single_intent(self, q):
+        # Company names may contain "and" (e.g. "... Power and Lighting"), so they are blanked out first.
+        for c in self.companies: q = c.pattern.sub(" ", q)
+        return not FACT_LOOKUP_CONJUNCTIONS.search(q)
+
+    def lookup(self, query):
+        """Answers only unambiguous single-intent questions the tables fully cover; anything else returns
+        None and falls through to retrieval, where a wrong direct answer can't short-circuit the LLM."""
+        q = query.lower()
+        if not self._single_intent(q): return None
+        result = None
+        if re.search(r"\b(ticker|symbol|stock code|trading code)\b", q):
+            if not FACT_LOOKUP_OUT_OF_SCOPE["ticker"].search(q): result = self._answer_ticker(query)
+        elif "tick size" in q or "minimum price movement" in q:
+            if not FACT_LOOKUP_OUT_OF_SCOPE["tick_size"].search(q): result = self._answer_tick_size(query)
+        elif re.search(r"\b(fees?|levy|commission)\b", q):
+            if not FACT_LOOKUP_OUT_OF_SCOPE["fees"].search(q): result = self._answer_fees(query)
+        elif re.search(r"trading (hours|times?|sessions?)|market (hours|open|close)|pre-open", q) and not any(w in q for w in DERIVATIVE_WORDS + ("bond",)):
+            if not FACT_LOOKUP_OUT_OF_SCOPE["sessions"].search(q): result = self._answer_sessions(query)
+        if not result: return None
+        answer, section = result
+        source = self.sources.get(section) if section else None
+        return answer, [source] if source else []
+
+
+class KeywordIndex:
+    """Persistent SQLite FTS5 index over every ingested chunk."""
+
+    def __init__(self, path=KEYWORD_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # chunk_meta maps the Pinecone vector id to the FTS rowid so updates never scan the index.
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunk_meta (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE, source TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunk_meta_source ON chunk_meta (source)")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(text)")
+        self.conn.commit()
+
+    def _delete_rowids(self, rowids):
+        self.conn.executemany("DELETE FROM chunks WHERE rowid = ?", [(r,) for r in rowids])
+        self.conn.executemany("DELETE FROM chunk_meta WHERE rowid = ?", [(r,) for r in rowids])
+
+    def upsert(self, rows):
+        # rows: iterable of (chunk_id, source, text); the last row wins for a repeated id.
+        rows = list({r[0]: r for r in rows}.values())
+        if not rows: return
+        with self.lock:
+            self._delete_rowids([r[0] for r in self.conn.execute(
+                f"SELECT rowid FROM chunk_meta WHERE id IN ({','.join('?' * len(rows))})", [r[0] for r in rows])])
+            for chunk_id, source, text in rows:
+                cur = self.conn.execute("INSERT INTO chunk_meta (id, source) VALUES (?, ?)", (chunk_id, source))
+                self.conn.execute("INSERT INTO chunks (rowid, text) VALUES (?, ?)", (cur.lastrowid, text))
+            self.conn.commit()
+
+    def delete(self, ids):
+        ids = list(ids)
+        if not ids: return
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i+500]
+                self._delete_rowids([r[0] for r in self.conn.execute(
+                    f"SELECT rowid FROM chunk_meta WHERE id IN ({','.join('?' * len(batch))})", batch)])
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM chunk_meta").fetchone()[0]
+
+    def search(self, query, limit=RETRIEVAL_TOP_K):
+        # Quote every term so tickers and rule numbers like "5.10" match as phrases.
+        terms = re.findall(r"\w+(?:\.\w+)*", query.lower())
+        if not terms: return []
+        match = " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT m.id, m.source, c.text, bm25(chunks) FROM chunks c JOIN chunk_meta m ON m.rowid = c.rowid "
+                "WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        return [{"id": r[0], "source": r[1], "text": r[2], "score": -r[3]} for r in rows]
+
+
+class EmbeddingCache:
+    """Disk-backed embedding store keyed by SHA-256 of (model, sanitized text)."""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, model=EMBEDDING_MODEL):
+        return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                rows = self.conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update((k, np.frombuffer(v, dtype=np.float32).tolist()) for k, v in rows)
+            self.hits += sum(1 for k in keys if k in found)
+            self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, items, model=EMBEDDING_MODEL):
+        # items: iterable of (key, vector)
+        rows = [(k, model, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items]
+        if not rows: return
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)", rows)
+            self.conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class EmbeddingBatcher:
+    """Packs chunks from many documents into token-bounded embedding requests.
+
+    A batch rejected for its inputs (`split_on`) is bisected so one bad chunk only fails itself; any other
+    error (auth, rate limit, outage) fails the whole batch at once rather than multiplying requests."""
+
+    def __init__(self, embed_fn, max_tokens=EMBED_BATCH_MAX_TOKENS, max_inputs=EMBED_BATCH_MAX_INPUTS,
+                 max_in_flight=EMBED_MAX_IN_FLIGHT, linger=EMBED_BATCH_LINGER_SECONDS, split_on=(BadRequestError,)):
+        self.embed_fn = embed_fn
+        self.split_on = split_on
+        self.max_tokens = max_tokens
+        self.max_inputs = max_inputs
+        self.linger = linger
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_tokens = 0
+        self.requests_sent = 0
+
+    def _dispatch_locked(self):
+        if not self.pending: return
+        batch, self.pending, self.pending_tokens = self.pending, [], 0
+        self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            self.requests_sent += 1
+            vectors = self.embed_fn([text for text, _ in batch])
+            for (_, future), vector in zip(batch, vectors): future.set_result(vector)
+        except Exception as e:
+            if len(batch) == 1 or not isinstance(e, self.split_on):
+                for _, future in batch: future.set_exception(e)
+                return
+            # Split and retry so one bad input only fails its own half.
+            mid = len(batch) // 2
+            self._run(batch[:mid])
+            self._run(batch[mid:])
+
+    def flush(self):
+        with self.lock:
+            self._dispatch_locked()
+
+    def submit(self, texts):
+        futures = []
+        with self.lock:
+            for text in texts:
+                tokens = count_tokens(text, EMBEDDING_MODEL)
+                if self.pending and (self.pending_tokens + tokens > self.max_tokens or len(self.pending) >= self.max_inputs):
+                    self._dispatch_locked()
+                future = concurrent.futures.Future()
+                self.pending.append((text, future))
+                self.pending_tokens += tokens
+                futures.append(future)
+        return futures
+
+    def embed(self, texts):
+        # Waits briefly so chunks from other documents can share the request, then flushes what is left.
+        futures = self.submit(texts)
+        _, not_done = concurrent.futures.wait(futures, timeout=self.linger)
+        if not_done: self.flush()
+        return [f.result() for f in futures]
+
+
+class IngestManifest:
+    """Per-URL record of validators, body hash and chunk ids from the last successful ingest."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, "
+            "chunk_ids TEXT, ingested_at REAL, seen_at REAL, ctype TEXT)"
+        )
+        ensure_columns(self.conn, "documents", {"ctype": "TEXT"})
+        self.conn.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content_hash, chunk_ids, ingested_at, seen_at, ctype FROM documents WHERE url = ?", (url,)
+            ).fetchone()
+        if not row: return None
+        return {
+            "url": url, "etag": row[0], "last_modified": row[1], "content_hash": row[2],
+            "chunk_ids": json.loads(row[3] or "[]"), "ingested_at": row[4], "seen_at": row[5], "ctype": row[6],
+        }
+
+    def record(self, url, etag, last_modified, content_hash, chunk_ids, ctype=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO documents (url, etag, last_modified, content_hash, chunk_ids, ingested_at, seen_at, ctype) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, content_hash, json.dumps(chunk_ids), now, now, ctype),
+            )
+            self.conn.commit()
+
+    def touch(self, url):
+        self.touch_many([url])
+
+    def touch_many(self, urls):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("UPDATE documents SET seen_at = ? WHERE url = ?", [(now, url) for url in urls])
+            self.conn.commit()
+
+    def chunk_ids(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT chunk_ids FROM documents").fetchall()
+        return {i for r in rows for i in json.loads(r[0] or "[]")}
+
+    def delete(self, url):
+        with self.lock:
+            self.conn.execute("DELETE FROM documents WHERE url = ?", (url,))
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM documents").fetchone()[0]
+
+    def sources(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT url, ctype, ingested_at, seen_at, etag, last_modified FROM documents").fetchall()
+        return [{"url": r[0], "ctype": r[1], "ingested_at": r[2], "seen_at": r[3], "etag": r[4], "last_modified": r[5]} for r in rows]
+
+    def unseen_since(self, timestamp):
+        with self.lock:
+            rows = self.conn.execute("SELECT url, chunk_ids FROM documents WHERE seen_at < ?", (timestamp,)).fetchall()
+        return [{"url": r[0], "chunk_ids": json.loads(r[1] or "[]")} for r in rows]
+
+
+def is_rejected_request(error):
+    # The request itself was refused (too large or malformed), so resending it unchanged cannot succeed.
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    return status in (400, 413)
+
+
+def retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try: return float(headers.get("Retry-After"))
+    except (TypeError, ValueError): return None
+
+
+class VectorUpserter:
+    """Packs vectors into upsert requests by serialized size and keeps several requests in flight.
+
+    A batch rejected for its size or contents (400/413) is split in half and each half retried, so one
+    oversized or malformed vector only costs itself. Rate limits, 5xx and connection errors say nothing
+    about the batch, so it is resent whole with backoff and failed as a whole if they persist. At most
+    two batches per worker are queued or in flight; `add` blocks beyond that, which backpressures the
+    embed stage."""
+
+    def __init__(self, index, on_success=None, target_bytes=UPSERT_TARGET_BYTES, max_vectors=UPSERT_MAX_VECTORS, workers=UPSERT_WORKERS,
+                 backoff=UPSERT_BACKOFF_SECONDS):
+        self.index = index
+        self.backoff = backoff
+        self.on_success = on_success
+        self.target_bytes = target_bytes
+        self.max_vectors = max_vectors
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.futures = set()
+        self.uploaded = 0
+        self.failed_ids = set()
+
+    @staticmethod
+    def payload_size(vector):
+        return len(json.dumps(vector, separators=(",", ":")))
+
+    def add(self, vectors):
+        full = []
+        with self.lock:
+            for v in vectors:
+                size = self.payload_size(v)
+                if self.pending and (self.pending_bytes + size > self.target_bytes or len(self.pending) >= self.max_vectors):
+                    full.append(self._take())
+                self.pending.append(v)
+                self.pending_bytes += size
+        # Submitted outside the lock: waiting for a slot must not stop finished batches from reporting in.
+        for batch in full: self._submit(batch)
+
+    def _take(self):
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        return batch
+
+    def _submit(self, batch):
+        self.slots.acquire()
+        try: future = self.executor.submit(self._send, batch)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock: self.futures.add(future)
+        future.add_done_callback(self._forget)
+
+    def _forget(self, future):
+        with self.lock: self.futures.discard(future)
+
+    def close(self):
+        with self.lock: batch = self._take()
+        if batch: self._submit(batch)
+        with self.lock: futures = list(self.futures)
+        concurrent.futures.wait(futures)
+        self.executor.shutdown()
+        return self.uploaded
+
+    def _send(self, batch):
+        try: self._upsert(batch)
+        finally: self.slots.release()
+
+    def _upsert(self, batch):
+        for attempt in range(UPSERT_MAX_RETRIES):
+            try:
+                self.index.upsert(vectors=batch)
+                if self.on_success: self.on_success(batch)
+                with self.lock: self.uploaded += len(batch)
+                return
+            except Exception as e:
+                if is_rejected_request(e):
+                    if len(batch) > 1:
+                        mid = len(batch) // 2
+                        self._upsert(batch[:mid])
+                        self._upsert(batch[mid:])
+                        return
+                    print(f"Pinecone Upsert Error: {e}")
+                    break
+                if attempt == UPSERT_MAX_RETRIES - 1:
+                    print(f"Pinecone Upsert Error after {UPSERT_MAX_RETRIES} attempts: {e}")
+                    break
+                time.sleep(retry_after(e) or self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        with self.lock: self.failed_ids.update(v["id"] for v in batch)
+
+
+class LocalIndexError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f"({status}) {reason}")
+        self.status = status
+
+
+class LocalVectorIndex:
+    """In-memory stand-in for a Pinecone index, for running ingestion and retrieval offline.
+
+    It rejects oversized upsert requests and can throttle to a request rate, so the upsert path
+    meets the same failures it would against the real service."""
+
+    def __init__(self, max_request_bytes=UPSERT_MAX_REQUEST_BYTES, requests_per_second=None):
+        self.max_request_bytes = max_request_bytes
+        self.requests_per_second = requests_per_second
+        self.lock = threading.Lock()
+        self.vectors = {}
+        self.calls = deque()
+        self.rejected = 0
+
+    def _admit(self):
+        if not self.requests_per_second: return
+        now = time.monotonic()
+        with self.lock:
+            while self.calls and now - self.calls[0] > 1.0: self.calls.popleft()
+            if len(self.calls) >= self.requests_per_second:
+                self.rejected += 1
+                raise LocalIndexError(429, "Too Many Requests")
+            self.calls.append(now)
+
+    def upsert(self, vectors):
+        self._admit()
+        size = len(json.dumps({"vectors": vectors}, separators=(",", ":")))
+        if size > self.max_request_bytes:
+            raise LocalIndexError(400, f"Request size {size} exceeds the maximum supported size of {self.max_request_bytes}")
+        with self.lock:
+            for v in vectors:
+                self.vectors[v["id"]] = (np.asarray(v["values"], dtype=np.float32), v.get("metadata", {}))
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids):
+        self._admit()
+        with self.lock:
+            for i in ids: self.vectors.pop(i, None)
+
+    def list(self, limit=100):
+        # Pages of ids, like Pinecone's serverless Index.list()
+        with self.lock: ids = sorted(self.vectors)
+        for i in range(0, len(ids), limit): yield ids[i:i+limit]
+
+    def query(self, vector, top_k=10, include_metadata=False, **kwargs):
+        self._admit()
+        with self.lock: items = list(self.vectors.items())
+        if not items: return {"matches": []}
+        matrix = np.stack([values for _, (values, _) in items])
+        q = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ q / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(q) + 1e-12)
+        return {"matches": [
+            {"id": items[i][0], "score": float(scores[i]), "metadata": items[i][1][1] if include_metadata else {}}
+            for i in np.argsort(-scores)[:top_k]
+        ]}
+
+    def describe_index_stats(self):
+        with self.lock: return {"total_vector_count": len(self.vectors), "dimension": PINECONE_DIMENSION}
+
+
+class RefreshCoordinator:
+    """Queue of knowledge base refresh jobs, shared by the API and the ingestion worker through one SQLite file.
+
+    Refreshes are single-flight: concurrent triggers merge into the active job, and the check-and-insert
+    runs under an immediate transaction so two processes cannot both enqueue a rebuild."""
+
+    ACTIVE = ("queued", "running")
+    COLUMNS = "id, status, force, created_at, started_at, finished_at, heartbeat_at, progress, message, scope, params"
+
+    def __init__(self, path=JOBS_PATH, freshness_seconds=REFRESH_FRESHNESS_SECONDS, lease_seconds=REFRESH_LEASE_SECONDS):
+        self.freshness_seconds = freshness_seconds
+        self.lease_seconds = lease_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS refresh_jobs ("
+            "id TEXT PRIMARY KEY, status TEXT, force INTEGER, created_at REAL, started_at REAL, "
+            "finished_at REAL, heartbeat_at REAL, progress TEXT, message TEXT, scope TEXT DEFAULT 'full', params TEXT)"
+        )
+        ensure_columns(self.conn, "refresh_jobs", {"scope": "TEXT DEFAULT 'full'", "params": "TEXT"})
+        self.conn.execute("CREATE INDEX IF NOT EXISTS refresh_jobs_status ON refresh_jobs (status, created_at)")
+
+    def _row(self, row):
+        if not row: return None
+        job = dict(zip(self.COLUMNS.split(", "), row))
+        job["force"] = bool(job["force"])
+        job["progress"] = json.loads(job["progress"] or "{}")
+        job["params"] = json.loads(job["params"] or "{}")
+        return job
+
+    def _transaction(self, fn):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self.conn.execute("COMMIT")
+                return result
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _active(self, now):
+        # Queued jobs no worker picked up, and running jobs that stopped heart-beating, no longer block triggers.
+        self.conn.execute(
+            "UPDATE refresh_jobs SET status = 'failed', finished_at = ?, message = 'No ingestion worker claimed the job.' "
+            "WHERE status = 'queued' AND heartbeat_at < ?", (now, now - self.lease_seconds)
+        )
+        self.conn.execute(
+            "UPDATE refresh_jobs SET status = 'failed', finished_at = ?, message = 'Abandoned: worker stopped responding.' "
+            "WHERE status = 'running' AND heartbeat_at < ?", (now, now - self.lease_seconds)
+        )
+        return self._row(self.conn.execute(
+            f"SELECT {self.COLUMNS} FROM refresh_jobs WHERE status IN ('queued', 'running') ORDER BY created_at LIMIT 1"
+        ).fetchone())
+
+    def _last_finished(self):
+        return self._row(self.conn.execute(
+            f"SELECT {self.COLUMNS} FROM refresh_jobs WHERE status = 'done' AND scope = 'full' ORDER BY finished_at DESC LIMIT 1"
+        ).fetchone())
+
+    def trigger(self, force=False, scope="full", params=None):
+        """Returns (job, created). `created` is False when the trigger merged into an active or fresh job.
+
+        Only full rebuilds are subject to the freshness window; a "sources" job refreshes just the URLs
+        in `params` and is still single-flight with everything else."""
+        now = time.time()
+
+        def enqueue():
+            active = self._active(now)
+            if active: return active["id"], False
+            last = self._last_finished()
+            if scope == "full" and last and not force and now - last["finished_at"] < self.freshness_seconds:
+                return last["id"], False
+            job_id = uuid.uuid4().hex
+            self.conn.execute(
+                "INSERT INTO refresh_jobs (id, status, force, created_at, heartbeat_at, progress, scope, params) "
+                "VALUES (?, 'queued', ?, ?, ?, '{}', ?, ?)",
+                (job_id, int(force), now, now, scope, json.dumps(params or {})),
+            )
+            return job_id, True
+
+        job_id, created = self._transaction(enqueue)
+        return self.get(job_id), created
+
+    def claim(self):
+        """Marks the oldest queued job as running and returns it, or None when the queue is empty."""
+        now = time.time()
+
+        def take():
+            row = self.conn.execute("SELECT id FROM refresh_jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row:
+                self.conn.execute(
+                    "UPDATE refresh_jobs SET status = 'running', started_at = ?, heartbeat_at = ? WHERE id = ?", (now, now, row[0])
+                )
+            return row and row[0]
+
+        job_id = self._transaction(take)
+        return self.get(job_id) if job_id else None
+
+    def get(self, job_id):
+        with self.lock:
+            return self._row(self.conn.execute(f"SELECT {self.COLUMNS} FROM refresh_jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def status(self):
+        now = time.time()
+        active, last = self._transaction(lambda: (self._active(now), self._last_finished()))
+        return {"active": active, "last_finished": last, "freshness_seconds": self.freshness_seconds}
+
+    def _set(self, job_id, **fields):
+        # Finished jobs are final: a late heartbeat or a worker finishing an abandoned job leaves them alone.
+        if "progress" in fields: fields["progress"] = json.dumps(fields["progress"])
+        assignments = ", ".join(f"{k} = ?" for k in fields)
+        with self.lock:
+            self.conn.execute(
+                f"UPDATE refresh_jobs SET {assignments} WHERE id = ? AND status IN ('queued', 'running')", (*fields.values(), job_id)
+            )
+
+    def heartbeat(self, job_id, progress=None):
+        if progress is None: self._set(job_id, heartbeat_at=time.time())
+        else: self._set(job_id, heartbeat_at=time.time(), progress=progress)
+
+    def run(self, job_id, build):
+        """Runs `build(progress)` as the job, heart-beating until it returns. Returns the final job."""
+        now = time.time()
+        self._set(job_id, status="running", started_at=now, heartbeat_at=now)
+        latest = {}
+        stop = threading.Event()
+
+        def progress(stage, **counts):
+            latest.clear()
+            latest.update(stage=stage, **counts)
+
+        def beat():
+            while not stop.wait(REFRESH_HEARTBEAT_SECONDS):
+                self.heartbeat(job_id, dict(latest))
+
+        beater = threading.Thread(target=beat, daemon=True)
+        beater.start()
+        try:
+            message, _ = build(progress)
+            self._set(job_id, status="done", finished_at=time.time(), progress=dict(latest), message=message)
+        except Exception as e:
+            self._set(job_id, status="failed", finished_at=time.time(), progress=dict(latest), message=str(e))
+            raise
+        finally:
+            stop.set()
+            beater.join()
+        return self.get(job_id)
+
+
+class RedisRefreshCoordinator(RefreshCoordinator):
+    """Redis-backed RefreshCoordinator, for running the API and the ingestion worker as separate services.
+    They must still share DATA_DIR: the keyword index, manifest and embedding cache are local SQLite.
+
+    The active job id is the single-flight lock; triggers check and claim it inside a WATCH transaction."""
+
+    JOB_TTL_SECONDS = 30 * 24 * 3600
+
+    def __init__(self, url, freshness_seconds=REFRESH_FRESHNESS_SECONDS, lease_seconds=REFRESH_LEASE_SECONDS, prefix="nse:refresh"):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.freshness_seconds = freshness_seconds
+        self.lease_seconds = lease_seconds
+        self.prefix = prefix
+        self.active_key = f"{prefix}:active"
+        self.queue_key = f"{prefix}:queue"
+        self.last_full_key = f"{prefix}:last_full"
+
+    def _key(self, job_id):
+        return f"{self.prefix}:job:{job_id}"
+
+    def get(self, job_id, client=None):
+        raw = (client or self.redis).get(self._key(job_id))
+        return json.loads(raw) if raw else None
+
+    def _put(self, job, client=None):
+        (client or self.redis).set(self._key(job["id"]), json.dumps(job), ex=self.JOB_TTL_SECONDS)
+
+    def _active(self, now, client=None):
+        client = client or self.redis
+        active_id = client.get(self.active_key)
+        job = self.get(active_id.decode(), client) if active_id else None
+        if job and job["status"] in self.ACTIVE and job["heartbeat_at"] >= now - self.lease_seconds: return job
+        return None
+
+    def _last_finished(self, client=None):
+        last_id = (client or self.redis).get(self.last_full_key)
+        return self.get(last_id.decode(), client) if last_id else None
+
+    def trigger(self, force=False, scope="full", params=None):
+        now = time.time()
+
+        def enqueue(pipe):
+            active = self._active(now, pipe)
+            if active: return active, False
+            last = self._last_finished(pipe)
+            if scope == "full" and last and not force and now - last["finished_at"] < self.freshness_seconds:
+                return last, False
+            stale_id = pipe.get(self.active_key)
+            if stale_id: pipe.watch(self._key(stale_id.decode()))
+            stale = self.get(stale_id.decode(), pipe) if stale_id else None
+            job = {
+                "id": uuid.uuid4().hex, "status": "queued", "force": force, "created_at": now, "started_at": None,
+                "finished_at": None, "heartbeat_at": now, "progress": {}, "message": None, "scope": scope, "params": params or {},
+            }
+            pipe.multi()
+            if stale and stale["status"] in self.ACTIVE:
+                stale.update(status="failed", finished_at=now, message="Abandoned: worker stopped responding.")
+                self._put(stale, pipe)
+            self._put(job, pipe)
+            pipe.set(self.active_key, job["id"])
+            pipe.rpush(self.queue_key, job["id"])
+            return job, True
+
+        return self.redis.transaction(enqueue, self.active_key, self.last_full_key, value_from_callable=True)
+
+    def claim(self):
+        while True:
+            job_id = self.redis.lpop(self.queue_key)
+            if not job_id: return None
+            job = self.get(job_id.decode())
+            if job and job["status"] == "queued":
+                now = time.time()
+                job = self._set(job["id"], status="running", started_at=now, heartbeat_at=now)
+                if job: return job
+
+    def status(self):
+        return {"active": self._active(time.time()), "last_finished": self._last_finished(), "freshness_seconds": self.freshness_seconds}
+
+    def _set(self, job_id, **fields):
+        """Updates the job under WATCH, so the heartbeat thread and the worker finishing the job cannot
+        interleave their read-modify-writes. Finished jobs are never rewritten. Returns the updated job."""
+
+        def update(pipe):
+            job = self.get(job_id, pipe)
+            if not job or job["status"] not in self.ACTIVE: return None
+            job.update(fields)
+            pipe.multi()
+            self._put(job, pipe)
+            if job["status"] == "done" and job["scope"] == "full": pipe.set(self.last_full_key, job_id)
+            return job
+
+        job = self.redis.transaction(update, self._key(job_id), value_from_callable=True)
+        if job and job["status"] not in self.ACTIVE:
+            # Release the single-flight lock only if it still belongs to this job.
+            with self.redis.pipeline() as watch:
+                try:
+                    watch.watch(self.active_key)
+                    if watch.get(self.active_key) == job_id.encode():
+                        watch.multi()
+                        watch.delete(self.active_key)
+                        watch.execute()
+                except Exception:
+                    pass
+        return job
+
+
+class RefreshScheduler:
+    """Enqueues whatever is due: a full rebuild once a day, otherwise the sources whose tier interval lapsed.
+
+    It runs inside the ingestion worker, which owns the manifest it reads."""
+
+    def __init__(self, engine, coordinator, tick_seconds=SCHEDULER_TICK_SECONDS):
+        self.engine = engine
+        self.coordinator = coordinator
+        self.tick_seconds = tick_seconds
+
+    def tick(self):
+        status = self.coordinator.status()
+        if status["active"]: return None
+        last = status["last_finished"]
+        if not last or time.time() - last["finished_at"] >= FULL_REFRESH_SECONDS:
+            job, created = self.coordinator.trigger()
+        else:
+            due = self.engine.due_sources()
+            if not due: return None
+            job, created = self.coordinator.trigger(scope="sources", params={"urls": due})
+        return job if created else None
+
+
+class MemoryCacheBackend:
+    """Process-local LRU store for SemanticCache entries.
+
+    The entries are private to the process, but the generation lives in a SQLite file in DATA_DIR, so a
+    refresh in the ingestion worker invalidates what the API serves."""
+
+    def __init__(self, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, generation_path=JOBS_PATH):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.seq = 0
+        self.conn = sqlite3.connect(generation_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache_generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER)")
+        self.conn.execute("INSERT OR IGNORE INTO cache_generation (id, value) VALUES (0, 0)")
+
+    def entries_since(self, generation, cursor):
+        """Entries of `generation` stored after `cursor`, and the cursor to pass next time."""
+        with self.lock:
+            rows = [e for e in self.entries.values() if e["seq"] > cursor and e["generation"] == generation]
+            return rows, self.seq
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, entry):
+        with self.lock:
+            # Another process bumped the generation; the older entries can never be served again.
+            if self.entries and next(reversed(self.entries.values()))["generation"] != entry["generation"]: self.entries.clear()
+            self.seq += 1
+            self.entries[entry["key"]] = {**entry, "seq": self.seq}
+            self.entries.move_to_end(entry["key"])
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def touch(self, key):
+        with self.lock:
+            if key in self.entries: self.entries.move_to_end(key)
+
+    def generation(self):
+        with self.lock:
+            return self.conn.execute("SELECT value FROM cache_generation WHERE id = 0").fetchone()[0]
+
+    def bump_generation(self):
+        with self.lock:
+            self.conn.execute("UPDATE cache_generation SET value = value + 1 WHERE id = 0")
+            self.entries.clear()
+            return self.conn.execute("SELECT value FROM cache_generation WHERE id = 0").fetchone()[0]
+
+
+class RedisCacheBackend:
+    """Redis store for SemanticCache entries, shared by every API worker.
+
+    Each generation keeps a log of its entry keys scored by insertion order, so a process can fetch just
+    the embeddings stored since it last looked instead of downloading the whole cache per query."""
+
+    def __init__(self, url, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL_SECONDS, prefix="nse:semcache"):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lru_key = f"{prefix}:lru"
+        self.seq_key = f"{prefix}:seq"
+        self.generation_key = f"{prefix}:generation"
+
+    def _key(self, key):
+        return f"{self.prefix}:entry:{key}"
+
+    def _log_key(self, generation):
+        return f"{self.prefix}:log:{generation}"
+
+    def entries_since(self, generation, cursor):
+        """Entries of `generation` stored after `cursor`, and the cursor to pass next time."""
+        logged = self.redis.zrangebyscore(self._log_key(generation), f"({cursor}", "+inf", withscores=True)
+        if not logged: return [], cursor
+        pipe = self.redis.pipeline()
+        for k, _ in logged: pipe.hmget(self._key(k.decode()), "embedding", "created", "generation")
+        rows = []
+        for (k, _), (embedding, created, entry_generation) in zip(logged, pipe.execute()):
+            if embedding is None or int(entry_generation) != generation: continue
+            rows.append({"key": k.decode(), "embedding": np.frombuffer(embedding, dtype=np.float32), "created": float(created)})
+        return rows, int(logged[-1][1])
+
+    def get(self, key):
+        raw = self.redis.hgetall(self._key(key))
+        if not raw: return None
+        return {
+            "key": key,
+            "embedding": np.frombuffer(raw[b"embedding"], dtype=np.float32),
+            "answer": raw[b"answer"].decode(),
+            "sources": json.loads(raw[b"sources"]),
+            "created": float(raw[b"created"]),
+            "generation": int(raw[b"generation"]),
+        }
+
+    def put(self, entry):
+        seq = self.redis.incr(self.seq_key)
+        log_key = self._log_key(entry["generation"])
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(entry["key"]), mapping={
+            "embedding": np.asarray(entry["embedding"], dtype=np.float32).tobytes(),
+            "answer": entry["answer"],
+            "sources": json.dumps(entry["sources"]),
+            "created": entry["created"],
+            "generation": entry["generation"],
+        })
+        pipe.expire(self._key(entry["key"]), self.ttl)
+        pipe.zadd(self.lru_key, {entry["key"]: time.time()})
+        pipe.zadd(log_key, {entry["key"]: seq})
+        pipe.expire(log_key, self.ttl)
+        pipe.execute()
+        # Expired entries are never touched, so they sit at the cold end of the LRU and go first here.
+        overflow = self.redis.zcard(self.lru_key) - self.max_entries
+        if overflow > 0:
+            evicted = [k.decode() for k in self.redis.zrange(self.lru_key, 0, overflow - 1)]
+            self.redis.delete(*[self._key(k) for k in evicted])
+            self.redis.zrem(self.lru_key, *evicted)
+            self.redis.zrem(log_key, *evicted)
+
+    def touch(self, key):
+        self.redis.zadd(self.lru_key, {key: time.time()}, xx=True)
+
+    def generation(self):
+        return int(self.redis.get(self.generation_key) or 0)
+
+    def bump_generation(self):
+        # Old entries are left to age out; lookups only read the current generation's log.
+        generation = self.redis.incr(self.generation_key)
+        self.redis.delete(self._log_key(generation - 1))
+        return generation
+
+
+class SemanticCache:
+    """Answer cache matched on query-embedding cosine similarity.
+
+    Each process mirrors the current generation's embeddings in a matrix and pulls only entries added
+    since its last lookup, so a query costs a generation read and usually an empty log read; the answer
+    itself is fetched only on a hit. Expired or evicted entries are skipped here and left to the backend's
+    TTL and LRU to remove, keeping deletes off the request path."""
+
+    def __init__(self, backend=None, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL_SECONDS):
+        self.backend = backend or MemoryCacheBackend()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, generation):
+        self.mirror_generation = generation
+        self.cursor = 0
+        self.keys = []
+        self.rows = {}
+        self.created = np.empty(0)
+        self.matrix = None
+        self.dead = set()
+
+    def _sync(self, generation):
+        with self.lock:
+            # Rows of evicted entries linger until the mirror is rebuilt, which bounds it at twice the cache.
+            if generation != self.mirror_generation or len(self.keys) > 2 * self.backend.max_entries: self._reset(generation)
+            fresh, self.cursor = self.backend.entries_since(generation, self.cursor)
+            added = []
+            for e in fresh:
+                if e["key"] in self.rows:
+                    self.created[self.rows[e["key"]]] = e["created"]
+                    self.dead.discard(e["key"])
+                else:
+                    self.rows[e["key"]] = len(self.keys) + len(added)
+                    added.append(e)
+            if added:
+                self.keys = self.keys + [e["key"] for e in added]
+                self.created = np.concatenate([self.created, [e["created"] for e in added]])
+                block = np.stack([e["embedding"] for e in added])
+                self.matrix = block if self.matrix is None else np.vstack([self.matrix, block])
+            return self.keys, self.created, self.matrix
+
+    def generation(self):
+        return self.backend.generation()
+
+    def invalidate(self):
+        return self.backend.bump_generation()
+
+    def lookup(self, embedding):
+        generation = self.backend.generation()
+        keys, created, matrix = self._sync(generation)
+        now = time.time()
+        if matrix is not None:
+            q = np.asarray(embedding, dtype=np.float32)
+            q = q / (np.linalg.norm(q) or 1)
+            scores = np.where(now - created > self.ttl, -np.inf, matrix @ q)
+            for i in sorted(np.flatnonzero(scores >= self.threshold), key=lambda i: -scores[i]):
+                if keys[i] in self.dead: continue
+                entry = self.backend.get(keys[i])
+                if entry and entry["generation"] == generation and now - entry["created"] <= self.ttl:
+                    self.hits += 1
+                    self.backend.touch(keys[i])
+                    return entry["answer"], entry["sources"]
+                with self.lock: self.dead.add(keys[i])
+        self.misses += 1
+        return None
+
+    def store(self, query, embedding, answer, sources, generation):
+        if not answer or NO_ANSWER_MARKER in answer or generation != self.backend.generation(): return
+        q = np.asarray(embedding, dtype=np.float32)
+        self.backend.put({
+            "key": hashlib.sha256(query.strip().lower().encode("utf-8")).hexdigest(),
+            "embedding": q / (np.linalg.norm(q) or 1),
+            "answer": answer,
+            "sources": list(sources),
+            "created": time.time(),
+            "generation": generation,
+        })
+
 
 class NSEKnowledgeBase:
-    def __init__(self, openai_api_key, pinecone_api_key):
-        if not openai_api_key or not pinecone_api_key:
+    def __init__(self, openai_api_key, pinecone_api_key, cache_backend=None, vector_index=None):
+        if not openai_api_key or not (pinecone_api_key or vector_index):
             raise ValueError("API Keys are required")
         
         self.api_key = openai_api_key
         self.client = OpenAI(api_key=self.api_key)
+        # One async client per engine so every coroutine shares its HTTP connection pool.
+        self.async_client = AsyncOpenAI(api_key=self.api_key)
+        self._connect_index(pinecone_api_key, vector_index)
+        self.async_index = None
+        self.session = requests.Session()
+        self.embedding_cache = EmbeddingCache()
+        self.embedding_batcher = EmbeddingBatcher(self._embed_remote)
+        self.keyword_index = KeywordIndex()
+        self.manifest = IngestManifest()
+        self.query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+        self.parse_pool = None
+        self.parse_pool_lock = threading.Lock()
+        self.answer_cache = SemanticCache(cache_backend)
+        self._build_fact_index()
+        self._load_fact_embeddings()
+
+    def _connect_index(self, pinecone_api_key, vector_index=None):
+        # A supplied index (e.g. LocalVectorIndex) replaces Pinecone entirely.
+        if vector_index is not None:
+            self.pc = None
+            self.index = vector_index
+            self.index_host = None
+            return
         self.pc = Pinecone(api_key=pinecone_api_key)
         
         # Ensure Index Exists
@@ -54,7 +1349,7 @@ class NSEKnowledgeBase:
                 print(f"Index creation warning: {e}")
             
         self.index = self.pc.Index(PINECONE_INDEX_NAME)
-        self.session = requests.Session()
+        self.index_host = self.pc.describe_index(PINECONE_INDEX_NAME).host
 
 
     # --- STATIC KNOWLEDGE ---
@@ -5417,17 +6712,139 @@ Flexibility: Implement various strategies to profit in different market conditio
 
         """
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
-    def get_embeddings_batch(self, texts):
-        if not texts: return []
+    # --- FACT SHEET INDEX ---
+    def _tokenize(self, text):
+        return re.findall(r"[a-z0-9]+", text.lower())
+
+    def _split_section(self, name, text):
+        header = f"[{name}]"
+        if name == "OFFICIAL_FAQ":
+            # One piece per Q/A pair so each FAQ entry is scored and packed on its own.
+            entries = [e.strip() for e in re.split(r"\n(?=\s*Q:)", text) if e.strip() and e.strip() != header]
+            return [e if e.startswith(header) else f"{header}\n{e}" for e in entries]
+        if len(text) <= FACT_SECTION_MAX_CHARS: return [text]
+        pieces, current = [], ""
+        for para in re.split(r"\n\s*\n", text):
+            lines = [para] if len(para) <= FACT_SECTION_MAX_CHARS else para.split("\n")
+            for part in lines:
+                if current and len(current) + len(part) > FACT_SECTION_MAX_CHARS:
+                    pieces.append(current.strip())
+                    current = ""
+                current += part[:FACT_SECTION_MAX_CHARS] + "\n\n"
+        if current.strip(): pieces.append(current.strip())
+        return [p if p.startswith(header) else f"{header} (continued)\n{p}" for p in pieces]
+
+    def _build_fact_index(self):
+        facts = self.get_static_facts()
+        markers = list(re.finditer(r"^\s*\[(OFFICIAL_[A-Z0-9_.]+)\]", facts, re.M))
+        self.fact_sections = []
+        full_sections = {}
+        for i, m in enumerate(markers):
+            end = markers[i + 1].start() if i + 1 < len(markers) else len(facts)
+            name = m.group(1)
+            full_sections[name] = facts[m.start():end]
+            for j, piece in enumerate(self._split_section(name, facts[m.start():end].strip())):
+                self.fact_sections.append({
+                    "name": name,
+                    "part": j,
+                    "text": piece,
+                    "tokens": count_tokens(piece),
+                })
+        self.fact_bm25 = BM25Okapi([self._tokenize(s["text"]) for s in self.fact_sections])
+        self.fact_matrix = None
+        self.fact_lookup = FactLookup(full_sections)
+        print(f"📚 Indexed {len(self.fact_sections)} fact-sheet sections from {len(markers)} markers.")
+
+    def _load_fact_embeddings(self):
+        # Goes through the embedding cache in DATA_DIR, so a restart only pays for sections that changed;
+        # only a fresh data directory embeds the whole fact sheet.
+        matrix = np.zeros((len(self.fact_sections), PINECONE_DIMENSION), dtype=np.float32)
+        try:
+            for i in range(0, len(self.fact_sections), 64):
+                batch = self.fact_sections[i:i+64]
+                for j, emb in enumerate(self.get_embeddings_batch([s["text"] for s in batch])): matrix[i + j] = emb
+        except Exception as e:
+            print(f"Fact embedding error: {e}")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.fact_matrix = matrix / np.where(norms == 0, 1, norms)
+
+    def get_fact_candidates(self, query, q_emb=None, top_k=FACT_CONTEXT_TOP_K):
+        # Same blend as the chunk ranking: cosine similarity plus a light BM25 term.
+        scores = self.fact_bm25.get_scores(self._tokenize(query)) * 0.1
+        if q_emb is not None and self.fact_matrix is not None:
+            scores = scores + self.fact_matrix @ np.asarray(q_emb, dtype=np.float32)
+
+        candidates = []
+        ranked = sorted(range(len(self.fact_sections)), key=lambda i: scores[i], reverse=True)
+        for i in ranked[:top_k]:
+            if scores[i] <= 0: break
+            section = self.fact_sections[i]
+            candidates.append({"text": section["text"], "score": float(scores[i]), "tokens": section["tokens"], "source": None})
+        # The core fact sheet (leadership, hours, segments) is always pinned.
+        for section in self.fact_sections:
+            if section["name"] == "OFFICIAL_FACT_SHEET":
+                candidates.append({"text": section["text"], "score": 0.0, "tokens": section["tokens"], "source": None, "pinned": True})
+        return candidates
+
+    def pack_context(self, candidate_groups, token_budget=CONTEXT_TOKEN_BUDGET):
+        # Scores are normalized per group (fact sections, retrieved chunks) so they compete on one scale,
+        # then pieces are taken greedily by score per token until the budget is spent.
+        pieces = []
+        for group in candidate_groups:
+            top = max((c["score"] for c in group), default=0) or 1
+            pieces += [dict(c, score=c["score"] / top) for c in group]
+
+        selected = [c for c in pieces if c.get("pinned")]
+        used = sum(c["tokens"] for c in selected)
+        seen = {c["text"] for c in selected}
+        for c in sorted(pieces, key=lambda c: c["score"] / max(c["tokens"], 1), reverse=True):
+            if c["text"] in seen or c["score"] <= 0 or used + c["tokens"] > token_budget: continue
+            selected.append(c)
+            seen.add(c["text"])
+            used += c["tokens"]
+
+        selected.sort(key=lambda c: (not c.get("pinned"), c["source"] is not None, -c["score"]))
+        return selected, used
+
+    def _cached_embeddings(self, texts):
+        # Returns (sanitized texts, their cache keys, vectors already on disk, unique texts still to embed).
         sanitized = [t.replace("\n", " ") for t in texts]
+        keys = [self.embedding_cache.key(t) for t in sanitized]
+        found = self.embedding_cache.get_many(keys)
+        missing = list(dict.fromkeys(t for t, k in zip(sanitized, keys) if k not in found))
+        return sanitized, keys, found, missing
+
+    def _store_embeddings(self, keys, found, missing, vectors):
+        fresh = [(self.embedding_cache.key(t), v) for t, v in zip(missing, vectors)]
+        self.embedding_cache.put_many(fresh)
+        found.update(fresh)
+        return [found[k] for k in keys]
+
+    # A rejected input fails the same way every time, so only transient errors are retried.
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(1), retry=retry_if_not_exception_type(BadRequestError), reraise=True)
+    def _embed_remote(self, sanitized):
         res = self.client.embeddings.create(input=sanitized, model=EMBEDDING_MODEL)
         return [d.embedding for d in res.data]
 
+    def get_embeddings_batch(self, texts):
+        if not texts: return []
+        sanitized, keys, found, missing = self._cached_embeddings(texts)
+        vectors = self._embed_remote(missing) if missing else []
+        return self._store_embeddings(keys, found, missing, vectors)
+
+    def embed_chunks(self, texts):
+        # Ingestion path: cache first, then the shared cross-document batcher for whatever is new.
+        if not texts: return []
+        sanitized, keys, found, missing = self._cached_embeddings(texts)
+        vectors = self.embedding_batcher.embed(missing) if missing else []
+        return self._store_embeddings(keys, found, missing, vectors)
+
     def get_embedding(self, text):
         return self.get_embeddings_batch([text])[0]
 
-    def build_knowledge_base(self):
+    def build_knowledge_base(self, force=False, progress=None):
+        progress = progress or (lambda stage, **counts: None)
+        started = time.time()
         seeds = [
            "https://www.nse.co.ke/",
             #Data Services Links
@@ -5463,111 +6880,321 @@ Flexibility: Implement various strategies to profit in different market conditio
 
         ]
 
-        print("🕷️ Crawling NSE website...")
-        found_pages, found_pdfs = self.crawl_site(seeds)
-        all_urls = list(set(found_pages + found_pdfs + hardcoded_pdfs))
-        
-        print(f"📝 Found {len(all_urls)} total documents.")
-        total_chunks = self.scrape_and_upload(all_urls)
+        print("🕷️ Crawling and ingesting NSE website...")
+        progress("crawling")
+        crawl_stats = {}
+        (found_pages, found_pdfs), total_chunks = self.crawl_and_upload(seeds + hardcoded_pdfs, force=force, progress=progress, stats=crawl_stats)
+        print(f"📝 Found {len(found_pages) + len(found_pdfs)} total documents.")
+        progress("sweeping", uploaded=total_chunks)
+        # A crawl cut short by the page budget never reached pages only linked from the ones it skipped, so
+        # their absence proves nothing; only a complete crawl may sweep.
+        if crawl_stats.get("budget_skipped"):
+            print("⚠️ Skipping stale sweep: the crawl hit its page budget.")
+            removed = 0
+        else:
+            removed = self.sweep_stale_vectors(started)
+        if total_chunks or removed: self.answer_cache.invalidate()
         
         return f"Knowledge Base Updated: {total_chunks} chunks uploaded to Pinecone.", []
 
-    def scrape_and_upload(self, urls):
-        total_uploaded = 0
-        
-        def process_url(url):
+    # --- SCHEDULED REFRESH ---
+    @staticmethod
+    def market_open(now=None):
+        now = (now or datetime.datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+        return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
+
+    @staticmethod
+    def last_market_close(now=None):
+        now = (now or datetime.datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+        day = now.date() if now.time() >= MARKET_CLOSE else now.date() - datetime.timedelta(days=1)
+        while day.weekday() >= 5: day -= datetime.timedelta(days=1)
+        return datetime.datetime.combine(day, MARKET_CLOSE, MARKET_TZ).timestamp()
+
+    @staticmethod
+    def refresh_tier(url, ctype=None):
+        if any(path in url for path in MARKET_DATA_PATHS): return "market"
+        if ctype == "pdf" or (ctype is None and url.lower().endswith(".pdf")): return "pdf"
+        return "html"
+
+    def due_sources(self, now=None):
+        # `seen_at` is the last time a source was fetched (or validated as unchanged), so it is the age that matters.
+        now = now or datetime.datetime.now(MARKET_TZ)
+        ts = now.timestamp()
+        market_open = self.market_open(now)
+        last_close = self.last_market_close(now)
+        due = []
+        for doc in self.manifest.sources():
+            checked = doc["seen_at"] or 0
+            tier = self.refresh_tier(doc["url"], doc["ctype"])
+            if tier == "market":
+                # While trading, every few minutes; after hours, once more to pick up the closing data.
+                stale = ts - checked >= MARKET_REFRESH_SECONDS if market_open else checked < last_close
+            elif tier == "pdf":
+                stale = ts - checked >= PDF_REFRESH_SECONDS
+            else:
+                stale = ts - checked >= HTML_REFRESH_SECONDS
+            if stale: due.append(doc["url"])
+        return due
+
+    def refresh_sources(self, urls, progress=None):
+        total_chunks = self.scrape_and_upload(urls, progress=progress)
+        if total_chunks: self.answer_cache.invalidate()
+        return f"Refreshed {len(urls)} sources: {total_chunks} chunks uploaded to Pinecone.", []
+
+    # --- INGESTION PIPELINE ---
+    @staticmethod
+    def _conditional_headers(previous, force=False):
+        headers = {}
+        if previous and previous["etag"] and not force: headers["If-None-Match"] = previous["etag"]
+        if previous and previous["last_modified"] and not force: headers["If-Modified-Since"] = previous["last_modified"]
+        return headers
+
+    def _fetch_stage(self, item, force=False, stats=None):
+        # Items are URLs to download, or (url, response) pairs the crawler already fetched.
+        url, res = item if isinstance(item, tuple) else (canonicalize_url(item), None)
+        previous = self.manifest.get(url)
+        if previous: self.manifest.touch(url)
+        if res is None: res = self._fetch_url(url, self._conditional_headers(previous, force))
+        if res.status_code in (404, 410) and previous:
+            self.remove_document(url, previous["chunk_ids"])
+            return None
+        if res.status_code == 304:
+            if stats is not None: stats["unchanged"] += 1
+            return None
+        if res.status_code != 200: return None
+
+        content_hash = hashlib.sha256(res.content).hexdigest()
+        if previous and previous["content_hash"] == content_hash and not force:
+            if stats is not None: stats["unchanged"] += 1
+            return None
+
+        ctype = "pdf" if url.lower().endswith(".pdf") or 'application/pdf' in res.headers.get('Content-Type', '') else "html"
+        return {
+            "url": url, "ctype": ctype, "content": res.content, "content_hash": content_hash,
+            "etag": res.headers.get("ETag"), "last_modified": res.headers.get("Last-Modified"),
+            "previous_chunk_ids": previous["chunk_ids"] if previous else [],
+        }
+
+    def _parse_processes(self, broken=None):
+        # Spawned rather than forked: the pipeline is multi-threaded and holds open SQLite connections.
+        # Every parse thread sees the same broken pool, so only the first to report it gets it replaced.
+        with self.parse_pool_lock:
+            if broken is not None and self.parse_pool is broken:
+                broken.shutdown(wait=False)
+                self.parse_pool = None
+            if self.parse_pool is None:
+                self.parse_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.parse_pool
+
+    def _parse_stage(self, doc):
+        # Raw bytes go to a worker process and only the extracted text comes back, so parsing uses every core.
+        args = (parse_document, doc["url"], doc["ctype"], doc.pop("content"))
+        pool = self._parse_processes()
+        try:
+            text, doc["pages"] = pool.submit(*args).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A dying worker (e.g. out of memory on a huge PDF) fails every parse queued on its pool, not just
+            # its own. Retry once on a fresh pool; a document that breaks that one too is dropped.
+            text, doc["pages"] = self._parse_processes(broken=pool).submit(*args).result()
+        if not text: return None
+        doc["chunks"] = self.simple_text_splitter(text)
+        return doc if doc["chunks"] else None
+
+    def _embed_stage(self, doc):
+        embeddings = self.embed_chunks(doc["chunks"])
+        vectors = []
+        for i, chunk in enumerate(doc.pop("chunks")):
+            vector_id = str(uuid.uuid5(uuid.NAMESPACE_URL, doc["url"] + str(i)))
+            metadata = {
+                "text": chunk[:30000], 
+                "source": doc["url"],
+                "date": datetime.date.today().isoformat(),
+                "type": doc["ctype"]
+            }
+            vectors.append({"id": vector_id, "values": embeddings[i], "metadata": metadata})
+        doc["vectors"] = vectors
+        return doc
+
+    def _index_keywords(self, batch):
+        self.keyword_index.upsert((v["id"], v["metadata"]["source"], v["metadata"]["text"]) for v in batch)
+
+    # --- STALE VECTOR GC ---
+    def delete_vectors(self, ids):
+        # Returns the ids that could not be deleted. Keyword rows only go once their vectors are gone, so the
+        # two indexes never disagree about a chunk; deletes are idempotent, so a failed batch is safe to retry.
+        failed = []
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            batch = ids[i:i+DELETE_BATCH_SIZE]
             try:
-                res = self._fetch_url(url)
-                if res.status_code != 200: return None
-                
-                ctype = "pdf" if url.lower().endswith(".pdf") or 'application/pdf' in res.headers.get('Content-Type', '') else "html"
-                text = self._process_content(url, ctype, res.content)
-                if not text: return None
-                
-                chunks = self.simple_text_splitter(text)
-                if not chunks: return None
-                
-                vectors = []
-                embeddings = self.get_embeddings_batch(chunks)
-                
-                for i, chunk in enumerate(chunks):
-                    vector_id = str(uuid.uuid5(uuid.NAMESPACE_URL, url + str(i)))
-                    metadata = {
-                        "text": chunk[:30000], 
-                        "source": url,
-                        "date": datetime.date.today().isoformat(),
-                        "type": ctype
-                    }
-                    vectors.append({"id": vector_id, "values": embeddings[i], "metadata": metadata})
-                
-                return vectors
+                self.index.delete(ids=batch)
             except Exception as e:
-                print(f"Error processing {url}: {e}")
-                return None
-
-        vectors_to_upload = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {executor.submit(process_url, u): u for u in urls}
-            for future in concurrent.futures.as_completed(futures):
-                res = future.result()
-                if res: vectors_to_upload.extend(res)
-        
-        for i in range(0, len(vectors_to_upload), 100):
-            batch = vectors_to_upload[i:i+100]
+                print(f"Pinecone Delete Error: {e}")
+                failed += batch
+                continue
             try:
-                self.index.upsert(vectors=batch)
-                total_uploaded += len(batch)
+                self.keyword_index.delete(batch)
             except Exception as e:
-                print(f"Pinecone Upsert Error: {e}")
-            time.sleep(0.2)
-            
-        return total_uploaded
+                print(f"Keyword Index Delete Error: {e}")
+                failed += batch
+        return failed
+
+    def remove_document(self, url, chunk_ids):
+        # The manifest row is what lets GC find these chunks again, so it stays until every delete succeeded.
+        if self.delete_vectors(chunk_ids): return False
+        self.manifest.delete(url)
+        return True
+
+    def sweep_stale_vectors(self, crawl_started):
+        # Sources the latest crawl never reached lose their vectors. A crawl that missed most of the
+        # tracked URLs is more likely a network failure than a site change, so the sweep backs off.
+        stale = self.manifest.unseen_since(crawl_started)
+        if not stale: return 0
+        tracked = self.manifest.count()
+        if len(stale) > tracked * STALE_SWEEP_MAX_FRACTION:
+            print(f"⚠️ Skipping stale sweep: {len(stale)} of {tracked} sources unseen this crawl.")
+            return 0
+        removed, kept = 0, 0
+        for doc in stale:
+            if self.remove_document(doc["url"], doc["chunk_ids"]): removed += len(doc["chunk_ids"])
+            else: kept += 1
+        print(f"🧹 Swept {removed} vectors from {len(stale) - kept} sources missing from the latest crawl.")
+        if kept: print(f"⚠️ {kept} sources kept in the manifest after delete errors; they'll be retried next sweep.")
+        return removed
+
+    def reconcile_untracked_vectors(self):
+        """Deletes vectors no manifest row lists, e.g. those written under raw-URL ids before the manifest
+        existed, which the sweep can never find. Run it while no refresh is running: an ingest in progress
+        has vectors it has not recorded yet. Returns the number deleted."""
+        tracked = self.manifest.chunk_ids()
+        if not tracked:
+            print("⚠️ The manifest is empty; refusing to reconcile, as every vector would count as untracked.")
+            return 0
+        untracked = [i for page in self.index.list() for i in page if i not in tracked]
+        failed = self.delete_vectors(untracked)
+        print(f"🧹 Deleted {len(untracked) - len(failed)} of {len(untracked)} untracked vectors ({len(tracked)} tracked).")
+        return len(untracked) - len(failed)
+
+    def scrape_and_upload(self, urls, force=False, progress=None):
+        cache_before = self.embedding_cache.stats()
+        stats = {"uploaded": 0, "documents": 0, "unchanged": 0, "pages": 0}
+        ingested = []
+        lock = threading.Lock()
+        upserter = VectorUpserter(self.index, on_success=self._index_keywords)
+
+        def upsert_stage(doc):
+            with lock:
+                stats["documents"] += 1
+                stats["pages"] += doc["pages"]
+                ingested.append({k: doc[k] for k in ("url", "ctype", "etag", "last_modified", "content_hash", "previous_chunk_ids")})
+                ingested[-1]["chunk_ids"] = [v["id"] for v in doc["vectors"]]
+                if progress: progress("ingesting", changed=stats["documents"], unchanged=stats["unchanged"])
+            upserter.add(doc["vectors"])
+
+        # fetch -> parse -> chunk/embed -> upsert, each stage with its own workers and a bounded queue in between.
+        run_pipeline(urls, [
+            ("fetch", lambda item: self._fetch_stage(item, force, stats), PIPELINE_FETCH_WORKERS),
+            ("parse", self._parse_stage, PIPELINE_PARSE_WORKERS),
+            ("embed", self._embed_stage, PIPELINE_EMBED_WORKERS),
+            ("upsert", upsert_stage, PIPELINE_UPSERT_WORKERS),
+        ])
+        stats["uploaded"] = upserter.close()
+        failed_ids = upserter.failed_ids
+
+        # Only documents whose every vector landed are recorded, so failures are retried next refresh.
+        # Chunks a document no longer produces (it shrank) are deleted once the new set is in place; any that
+        # fail to delete stay listed against the document so the next refresh or sweep retries them.
+        recorded = [doc for doc in ingested if not failed_ids.intersection(doc["chunk_ids"])]
+        leftovers = {doc["url"]: sorted(set(doc["previous_chunk_ids"]) - set(doc["chunk_ids"])) for doc in recorded}
+        undeleted = set()
+        if any(leftovers.values()):
+            print(f"🧹 Deleting {sum(map(len, leftovers.values()))} leftover chunks from re-chunked documents.")
+            undeleted = set(self.delete_vectors([i for ids in leftovers.values() for i in ids]))
+        for doc in recorded:
+            chunk_ids = doc["chunk_ids"] + [i for i in leftovers[doc["url"]] if i in undeleted]
+            self.manifest.record(doc["url"], doc["etag"], doc["last_modified"], doc["content_hash"], chunk_ids, doc["ctype"])
+
+        cache_after = self.embedding_cache.stats()
+        print(f"🧠 Embedding cache: {cache_after['hits'] - cache_before['hits']} hits, "
+              f"{cache_after['misses'] - cache_before['misses']} misses.")
+        print(f"📤 Ingested {stats['documents']} documents ({stats['pages']} pages), skipped {stats['unchanged']} unchanged.")
+        return stats["uploaded"]
+
+    def _rewrite_prompt(self, query):
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        return f"Generate 3 search queries for: '{query}'\nDate: {today}\n1. Keyword\n2. Concept\n3. Doc type\nOutput 3 lines."
+
+    def _parse_rewrites(self, content):
+        lines = [re.sub(r"^\d+[.)]\s*", "", q.strip()) for q in content.split('\n')]
+        return [q for q in lines if q]
 
     def generate_context_queries(self, query):
-        today = datetime.date.today().strftime("%Y-%m-%d")
-        prompt = f"Generate 3 search queries for: '{query}'\nDate: {today}\n1. Keyword\n2. Concept\n3. Doc type\nOutput 3 lines."
         try:
-            res = self.client.chat.completions.create(model=LLM_MODEL, messages=[{"role": "user", "content": prompt}])
-            return [q.strip() for q in res.choices[0].message.content.split('\n') if q.strip()]
+            res = self.client.chat.completions.create(model=LLM_MODEL, messages=[{"role": "user", "content": self._rewrite_prompt(query)}])
+            return self._parse_rewrites(res.choices[0].message.content)
         except: return [query]
 
-    def answer_question(self, query):
-        context_text = self.get_static_facts() + "\n\n"
-        visible_sources = set()
-        
-        try:
-            queries = self.generate_context_queries(query)
-            q_emb = self.get_embedding(queries[0])
-            
-            results = self.index.query(vector=q_emb, top_k=15, include_metadata=True)
-            
-            if results['matches']:
-                docs = [m['metadata']['text'] for m in results['matches']]
-                metas = [m['metadata'] for m in results['matches']]
-                
-                tokenized_query = query.lower().split()
-                tokenized_docs = [doc.lower().split() for doc in docs]
-                
-                bm25 = BM25Okapi(tokenized_docs)
-                doc_scores = bm25.get_scores(tokenized_query)
-                
-                final_ranking = []
-                for i, match in enumerate(results['matches']):
-                    hybrid_score = match['score'] + (doc_scores[i] * 0.1)
-                    
-                    if "[OFFICIAL_FAQ]" in docs[i]: hybrid_score += 0.5
-                    if "[OFFICIAL_FACT_SHEET]" in docs[i]: hybrid_score += 1.0
-                    
-                    final_ranking.append((hybrid_score, docs[i], metas[i]['source']))
-                
-                final_ranking.sort(key=lambda x: x[0], reverse=True)
-                
-                for _, text, source in final_ranking[:5]:
-                    context_text += f"\n[Source: {source}]\n{text}\n---"
-                    visible_sources.add(source)
+    def reciprocal_rank_fusion(self, ranked_lists, k=RRF_K):
+        scores = defaultdict(float)
+        for ranked in ranked_lists:
+            for rank, item_id in enumerate(ranked):
+                scores[item_id] += 1.0 / (k + rank + 1)
+        return scores
+
+    def submit_dense_queries(self, embeddings):
+        # One Pinecone query per embedding, all in flight at once.
+        return [
+            self.query_executor.submit(self.index.query, vector=e, top_k=RETRIEVAL_TOP_K, include_metadata=True)
+            for e in embeddings
+        ]
 
-        except Exception as e:
-            print(f"Retrieval Error: {e}")
+    def search_chunks(self, dense_futures, keyword_future=None):
+        dense_results = []
+        for future in dense_futures:
+            try:
+                dense_results.append(future.result()['matches'])
+            except Exception as e:
+                print(f"Pinecone Query Error: {e}")
+
+        keyword_hits = []
+        if keyword_future is not None:
+            try:
+                keyword_hits = keyword_future.result()
+            except Exception as e:
+                print(f"Keyword Search Error: {e}")
+        return self.fuse_results(dense_results, keyword_hits)
+
+    def fuse_results(self, dense_results, keyword_hits):
+        ranked_lists, texts = [], {}
+        for matches in dense_results:
+            ranked_lists.append([m['id'] for m in matches])
+            for m in matches: texts[m['id']] = (m['metadata']['text'], m['metadata']['source'])
+
+        ranked_lists.append([h["id"] for h in keyword_hits])
+        for h in keyword_hits: texts.setdefault(h["id"], (h["text"], h["source"]))
+
+        final_ranking = []
+        for chunk_id, score in self.reciprocal_rank_fusion(ranked_lists).items():
+            text, source = texts[chunk_id]
+            if "[OFFICIAL_FAQ]" in text: score += 0.5
+            if "[OFFICIAL_FACT_SHEET]" in text: score += 1.0
+            final_ranking.append((score, text, source))
+
+        final_ranking.sort(key=lambda x: x[0], reverse=True)
+        return final_ranking
+
+    def _build_messages(self, query, q_emb, final_ranking):
+        chunk_candidates = []
+        for score, text, source in final_ranking[:CHUNK_CONTEXT_TOP_K]:
+            piece = f"\n[Source: {source}]\n{text}\n---"
+            chunk_candidates.append({"text": piece, "score": score, "tokens": count_tokens(piece), "source": source})
+
+        selected, used_tokens = self.pack_context([self.get_fact_candidates(query, q_emb), chunk_candidates])
+        context_text = "\n\n".join(c["text"] for c in selected if c["source"] is None) + "\n\n"
+        context_text += "".join(c["text"] for c in selected if c["source"] is not None)
+        visible_sources = list(dict.fromkeys(c["source"] for c in selected if c["source"] is not None))
+        print(f"📦 Context packed: {used_tokens}/{CONTEXT_TOKEN_BUDGET} tokens from {len(selected)} pieces.")
         
         today = datetime.date.today().strftime("%Y-%m-%d")
         system_prompt = f"""You are the NSE Digital Assistant.
@@ -5578,68 +7205,420 @@ Flexibility: Implement various strategies to profit in different market conditio
         - If unsure, say "My apologies. I cannot find that specific info. I will continue updating my market knowlegde"
         CONTEXT: {context_text}"""
 
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": query}]
+        return messages, visible_sources
+
+    def _lookup_cached_answer(self, q_emb):
+        if q_emb is None: return None
+        try:
+            return self.answer_cache.lookup(q_emb)
+        except Exception as e:
+            print(f"Answer Cache Error: {e}")
+            return None
+
+    def answer_question(self, query):
+        direct = self.fact_lookup.lookup(query)
+        if direct: return direct
+
+        q_emb = None
+        dense_futures = []
+        started = time.monotonic()
+        # The rewrite starts with the embedding so it overlaps the cache lookup and the first pass; on a
+        # cache hit its result is simply ignored.
+        rewrite_future = self.query_executor.submit(self.generate_context_queries, query)
+        generation = self.answer_cache.generation()
+        keyword_future = self.query_executor.submit(self.keyword_index.search, query, RETRIEVAL_TOP_K)
+
+        try:
+            q_emb = self.get_embedding(query)
+        except Exception as e:
+            print(f"Query Embedding Error: {e}")
+
+        cached = self._lookup_cached_answer(q_emb)
+        if cached:
+            rewrite_future.cancel()
+            return cached
+
+        # First pass on the raw query runs while the rewrite is still being generated.
+        if q_emb is not None: dense_futures += self.submit_dense_queries([q_emb])
+
+        try:
+            remaining = REWRITE_DEADLINE_SECONDS - (time.monotonic() - started)
+            rewrites = [q for q in dict.fromkeys(rewrite_future.result(timeout=max(0, remaining))) if q != query]
+            if rewrites: dense_futures += self.submit_dense_queries(self.get_embeddings_batch(rewrites))
+        except concurrent.futures.TimeoutError:
+            print(f"Query rewrite missed the {REWRITE_DEADLINE_SECONDS}s deadline; using first-pass results.")
+        except Exception as e:
+            print(f"Query Rewrite Error: {e}")
+
+        final_ranking = []
+        try:
+            final_ranking = self.search_chunks(dense_futures, keyword_future)
+        except Exception as e:
+            print(f"Retrieval Error: {e}")
+
+        messages, visible_sources = self._build_messages(query, q_emb, final_ranking)
         stream = self.client.chat.completions.create(
             model=LLM_MODEL,
-            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": query}],
+            messages=messages,
             temperature=0,
-            stream=True
+            stream=True,
+            stream_options={"include_usage": True}
         )
-        return stream, list(visible_sources)
+        if q_emb is not None:
+            stream = self._cache_stream(stream, query, q_emb, visible_sources, generation)
+        return stream, visible_sources
+
+    def _cache_stream(self, stream, query, q_emb, sources, generation):
+        # Passes chunks through untouched and caches the answer once the stream is drained.
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content: parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        try:
+            self.answer_cache.store(query, q_emb, "".join(parts), sources, generation)
+        except Exception as e:
+            print(f"Answer Cache Error: {e}")
+
+    # --- ASYNC QUERY PATH ---
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(1), retry=retry_if_not_exception_type(BadRequestError), reraise=True)
+    async def _embed_remote_async(self, sanitized):
+        res = await self.async_client.embeddings.create(input=sanitized, model=EMBEDDING_MODEL)
+        return [d.embedding for d in res.data]
+
+    async def get_embeddings_batch_async(self, texts):
+        if not texts: return []
+        # The embedding cache is SQLite, so its reads and commits run off the event loop.
+        sanitized, keys, found, missing = await asyncio.to_thread(self._cached_embeddings, texts)
+        vectors = await self._embed_remote_async(missing) if missing else []
+        return await asyncio.to_thread(self._store_embeddings, keys, found, missing, vectors)
+
+    async def get_embedding_async(self, text):
+        return (await self.get_embeddings_batch_async([text]))[0]
+
+    async def query_index_async(self, embedding):
+        if self.index_host is None:
+            res = await asyncio.to_thread(self.index.query, vector=embedding, top_k=RETRIEVAL_TOP_K, include_metadata=True)
+            return res['matches']
+        # The async index owns an HTTP pool bound to the running loop, so it is created on first use.
+        if self.async_index is None:
+            self.async_index = self.pc.IndexAsyncio(host=self.index_host)
+        res = await self.async_index.query(vector=embedding, top_k=RETRIEVAL_TOP_K, include_metadata=True)
+        return res['matches']
+
+    async def generate_context_queries_async(self, query):
+        try:
+            res = await self.async_client.chat.completions.create(model=LLM_MODEL, messages=[{"role": "user", "content": self._rewrite_prompt(query)}])
+            return self._parse_rewrites(res.choices[0].message.content)
+        except Exception: return [query]
+
+    async def answer_question_async(self, query):
+        direct = self.fact_lookup.lookup(query)
+        if direct: return direct
+
+        q_emb = None
+        dense_tasks = []
+        started = time.monotonic()
+        # The rewrite starts with the embedding so it overlaps the cache lookup and the first pass.
+        rewrite_task = asyncio.create_task(self.generate_context_queries_async(query))
+        # The answer cache may be Redis and the keyword index is SQLite; both are blocking, so they run in threads.
+        generation = await asyncio.to_thread(self.answer_cache.generation)
+        keyword_task = asyncio.create_task(asyncio.to_thread(self.keyword_index.search, query, RETRIEVAL_TOP_K))
+
+        try:
+            q_emb = await self.get_embedding_async(query)
+        except Exception as e:
+            print(f"Query Embedding Error: {e}")
+
+        cached = await asyncio.to_thread(self._lookup_cached_answer, q_emb)
+        if cached:
+            rewrite_task.cancel()
+            keyword_task.cancel()
+            return cached
+
+        # First pass on the raw query runs while the rewrite is still being generated.
+        if q_emb is not None: dense_tasks.append(asyncio.create_task(self.query_index_async(q_emb)))
+
+        remaining = REWRITE_DEADLINE_SECONDS - (time.monotonic() - started)
+        done, _ = await asyncio.wait({rewrite_task}, timeout=max(0, remaining))
+        if rewrite_task in done:
+            try:
+                rewrites = [q for q in dict.fromkeys(rewrite_task.result()) if q != query]
+                if rewrites:
+                    for emb in await self.get_embeddings_batch_async(rewrites):
+                        dense_tasks.append(asyncio.create_task(self.query_index_async(emb)))
+            except Exception as e:
+                print(f"Query Rewrite Error: {e}")
+        else:
+            rewrite_task.cancel()
+            print(f"Query rewrite missed the {REWRITE_DEADLINE_SECONDS}s deadline; using first-pass results.")
+
+        dense_results = []
+        for result in await asyncio.gather(*dense_tasks, return_exceptions=True):
+            if isinstance(result, Exception): print(f"Pinecone Query Error: {result}")
+            else: dense_results.append(result)
+        try:
+            keyword_hits = await keyword_task
+        except Exception as e:
+            print(f"Keyword Search Error: {e}")
+            keyword_hits = []
+
+        messages, visible_sources = self._build_messages(query, q_emb, self.fuse_results(dense_results, keyword_hits))
+        stream = await self.async_client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=messages,
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        if q_emb is not None:
+            stream = self._cache_stream_async(stream, query, q_emb, visible_sources, generation)
+        return stream, visible_sources
+
+    async def _cache_stream_async(self, stream, query, q_emb, sources, generation):
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content: parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        try:
+            await asyncio.to_thread(self.answer_cache.store, query, q_emb, "".join(parts), sources, generation)
+        except Exception as e:
+            print(f"Answer Cache Error: {e}")
+
+    async def aclose(self):
+        if self.async_index is not None: await self.async_index.close()
+        await self.async_client.close()
 
     @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-    def _fetch_url(self, url):
-        headers = {'User-Agent': 'Mozilla/5.0'}
+    def _fetch_url(self, url, extra_headers=None):
+        headers = {'User-Agent': 'Mozilla/5.0', **(extra_headers or {})}
         return self.session.get(url, headers=headers, verify=False, timeout=10)
 
-    def crawl_site(self, seed_urls):
-        visited = set()
-        to_visit = set(seed_urls)
+    def crawl_site(self, seed_urls, domain=CRAWL_DOMAIN):
+        return asyncio.run(self.crawl_site_async(seed_urls, domain))
+
+    def crawl_and_upload(self, seed_urls, force=False, progress=None, domain=CRAWL_DOMAIN, stats=None):
+        """Crawls and ingests in one pass: every response the crawler fetches goes straight into the pipeline.
+
+        Returns ((found_pages, found_pdfs), chunks_uploaded). `stats` receives the crawler's counters."""
+        responses = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        found = {}
+
+        def crawl():
+            try:
+                found["urls"] = asyncio.run(self.crawl_site_async(seed_urls, domain, on_response=responses.put, force=force, stats=stats))
+            finally:
+                responses.put(_STOP)
+
+        def fetched():
+            while True:
+                item = responses.get()
+                if item is _STOP: return
+                yield item
+
+        crawler = threading.Thread(target=crawl, daemon=True)
+        crawler.start()
+        total_chunks = self.scrape_and_upload(fetched(), force=force, progress=progress)
+        crawler.join()
+        return found.get("urls", ([], [])), total_chunks
+
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+    async def _fetch_url_async(self, client, url, headers=None):
+        return await client.get(url, headers=headers)
+
+    @staticmethod
+    def crawl_priority(url, depth, seed_sections=(), recent=frozenset(), weights=CRAWL_PRIORITY_WEIGHTS):
+        path = urlparse(url).path.lower()
+        score = depth * weights["depth"]
+        if any(url.startswith(section) for section in seed_sections): score += weights["seed_section"]
+        if "/dataservices/" in path: score += weights["dataservices"]
+        if path.endswith(".pdf"): score += weights["pdf"]
+        # Recency: the page changed at its last ingest, or its upload path carries a recent year.
+        year = re.search(r"/(20\d\d)/", path)
+        if url in recent or (year and int(year.group(1)) >= datetime.date.today().year - 1): score += weights["recent"]
+        elif year: score += weights["old_year"]
+        return score
+
+    async def discover_urls_async(self, fetch, origin, use_rest=DISCOVERY_USE_WP_REST):
+        """Enumerates a WordPress site from robots.txt, its sitemaps and sitemap indexes, and optionally the
+        WP REST listings. Returns {url: lastmod timestamp or None}; failures just yield fewer URLs."""
+        found = {}
+        sitemaps = [urljoin(origin, path) for path in SITEMAP_PATHS]
+        try:
+            res = await fetch(urljoin(origin, "/robots.txt"))
+            if res.status_code == 200: sitemaps = re.findall(r"(?im)^\s*sitemap:\s*(\S+)", res.text) + sitemaps
+        except Exception:
+            pass
+
+        read = set()
+        while sitemaps and len(read) < SITEMAP_MAX_FILES:
+            sitemap = sitemaps.pop(0)
+            if sitemap in read: continue
+            read.add(sitemap)
+            try:
+                res = await fetch(sitemap)
+                if res.status_code != 200: continue
+                root = ElementTree.fromstring(res.content)
+            except Exception:
+                continue
+            for entry in root:
+                loc = (entry.findtext("{*}loc") or "").strip()
+                if not loc: continue
+                if root.tag.endswith("sitemapindex"): sitemaps.append(loc)
+                else: found[loc] = parse_lastmod(entry.findtext("{*}lastmod"))
+
+        if not use_rest: return found
+        for path, key in WP_REST_ENDPOINTS:
+            page, pages = 1, 1
+            while page <= min(pages, WP_REST_MAX_PAGES):
+                try:
+                    res = await fetch(f"{urljoin(origin, path)}?per_page=100&page={page}&_fields={key},modified_gmt,mime_type")
+                    if res.status_code != 200: break
+                    pages = int(res.headers.get("X-WP-TotalPages", 1))
+                    items = res.json()
+                except Exception:
+                    break
+                for item in items:
+                    if key == "source_url" and item.get("mime_type") != "application/pdf": continue
+                    if item.get(key): found.setdefault(item[key], parse_lastmod(item.get("modified_gmt")))
+                page += 1
+        return found
+
+    @staticmethod
+    def _extract_links(url, content):
+        soup = BeautifulSoup(content, 'html.parser')
+        return [urljoin(url, link['href']) for link in soup.find_all('a', href=True)]
+
+    async def crawl_site_async(self, seed_urls, domain=CRAWL_DOMAIN,
+                               concurrency=CRAWL_CONCURRENCY, per_host=CRAWL_PER_HOST_CONCURRENCY,
+                               delay=CRAWL_POLITENESS_DELAY_SECONDS, on_response=None, force=False,
+                               max_depth=MAX_CRAWL_DEPTH, priority=None, discover=True, stats=None):
+        # Workers share one connection pool; each host gets its own concurrency cap and a minimum
+        # gap between request starts so the crawl stays polite to nse.co.ke.
+        # With `on_response`, every (url, response) is handed to ingestion so nothing is downloaded twice.
+        # Known PDFs are then fetched conditionally; HTML is always fetched in full because its links drive the crawl.
+        # The frontier is ordered by `priority(url, depth)` so the page budget goes to the valuable pages first,
+        # and pages at `max_depth` are fetched but not expanded.
+        # With `discover`, sitemap and WP REST URLs join the frontier while the seeds are already being fetched.
+        # URLs left in the frontier when the MAX_PAGES_TO_CRAWL budget runs out still count as seen, and
+        # `stats["budget_skipped"]` tells the caller the crawl was cut short.
+        now = time.time()
+        # One manifest read up front: per-URL SQLite lookups on the event loop would stall every crawl worker.
+        known = {d["url"]: d for d in await asyncio.to_thread(self.manifest.sources)}
+        recent = {url for url, d in known.items() if now - (d["ingested_at"] or 0) < CRAWL_RECENT_SECONDS}
+        if priority is None:
+            seed_sections = [u for u in seed_urls if urlparse(u).path.strip("/") and not u.lower().endswith(".pdf")]
+            priority = lambda url, depth: self.crawl_priority(url, depth, seed_sections, recent)
+        # Every URL is canonicalized before the visited check; `variants` keeps the raw spellings so the
+        # run can report how many duplicates that collapsed.
+        seed_urls = [u for u in seed_urls if in_domain(u, domain)]
+        variants = set(seed_urls)
+        seed_urls = list(dict.fromkeys(canonicalize_url(u) for u in seed_urls))
+        visited = set(seed_urls)
+        frontier = asyncio.PriorityQueue()
+        order = itertools.count()
+        for url in seed_urls: frontier.put_nowait((priority(url, 0), next(order), url, 0))
         found_pages = set()
         found_pdfs = set()
-        count = 0
-        while to_visit and count < MAX_PAGES_TO_CRAWL:
-            try: url = to_visit.pop()
-            except: break
-            if url in visited: continue
-            visited.add(url)
-            
-            if "nse.co.ke" not in url: continue
-            
-            try:
-                res = self._fetch_url(url)
-                if res.status_code == 200:
+        fetched = 0
+        budget_skipped = []
+        host_slots = defaultdict(lambda: asyncio.Semaphore(per_host))
+        host_next_start = defaultdict(float)
+
+        async def polite_fetch(client, url):
+            host = urlparse(url).netloc
+            headers = None
+            if on_response and url.lower().endswith(".pdf"):
+                headers = self._conditional_headers(known.get(url), force)
+            async with host_slots[host]:
+                loop = asyncio.get_running_loop()
+                wait = host_next_start[host] - loop.time()
+                host_next_start[host] = max(host_next_start[host], loop.time()) + delay
+                if wait > 0: await asyncio.sleep(wait)
+                return await self._fetch_url_async(client, url, headers)
+
+        async def worker(client):
+            nonlocal fetched
+            while True:
+                _, _, url, depth = await frontier.get()
+                try:
+                    if fetched >= MAX_PAGES_TO_CRAWL:
+                        budget_skipped.append(url)
+                        continue
+                    fetched += 1
+                    res = await polite_fetch(client, url)
+                    if on_response: await asyncio.to_thread(on_response, (url, res))
+                    if res.status_code == 304: found_pdfs.add(url)
+                    if res.status_code != 200: continue
                     if url.endswith(".pdf") or 'pdf' in res.headers.get('Content-Type', ''):
                         found_pdfs.add(url)
-                    else:
-                        found_pages.add(url)
-                        soup = BeautifulSoup(res.content, 'html.parser')
-                        for link in soup.find_all('a', href=True):
-                            full = urljoin(url, link['href'])
-                            if "nse.co.ke" in full and full not in visited:
-                                to_visit.add(full)
-                count += 1
-            except: pass
+                        continue
+                    found_pages.add(url)
+                    if depth >= max_depth: continue
+                    for raw in await asyncio.to_thread(self._extract_links, url, res.content):
+                        if not in_domain(raw, domain): continue
+                        variants.add(raw)
+                        full = canonicalize_url(raw)
+                        if full not in visited:
+                            visited.add(full)
+                            frontier.put_nowait((priority(full, depth + 1), next(order), full, depth + 1))
+                except Exception:
+                    # A timeout or dropped connection says nothing about whether the page still exists, so it
+                    # counts as seen; otherwise the stale sweep would delete a live page's vectors.
+                    if on_response: await asyncio.to_thread(self.manifest.touch, url)
+                finally:
+                    frontier.task_done()
+
+        async def discover_site(client):
+            # A page the sitemap says has not changed since we last ingested it is only marked seen, never downloaded.
+            # Compared against ingested_at, not seen_at: a fetch touches seen_at up front, even if that refresh then
+            # failed to parse, embed or upsert the page.
+            # Seeds are always fetched (their links drive the fallback crawl) and so are market data pages,
+            # whose figures change without WordPress bumping lastmod.
+            skip_unchanged = on_response is not None and not force
+            listed = 0
+            unchanged = []
+            origins = dict.fromkeys(f"{urlsplit(u).scheme}://{urlsplit(u).netloc}/" for u in seed_urls)
+            for origin in origins:
+                discovered = await self.discover_urls_async(lambda url: polite_fetch(client, url), origin)
+                for raw, lastmod in discovered.items():
+                    if not in_domain(raw, domain): continue
+                    variants.add(raw)
+                    url = canonicalize_url(raw)
+                    if url in visited: continue
+                    visited.add(url)
+                    listed += 1
+                    if lastmod and now - lastmod < CRAWL_RECENT_SECONDS: recent.add(url)
+                    previous = known.get(url) if skip_unchanged and lastmod else None
+                    if previous and lastmod <= (previous["ingested_at"] or 0) and self.refresh_tier(url, previous["ctype"]) != "market":
+                        (found_pdfs if previous["ctype"] == "pdf" else found_pages).add(url)
+                        unchanged.append(url)
+                        continue
+                    frontier.put_nowait((priority(url, 1), next(order), url, 1))
+            if unchanged: await asyncio.to_thread(self.manifest.touch_many, unchanged)
+            print(f"🗺️ Discovery listed {listed} URLs; {len(unchanged)} unchanged since last ingest and skipped.")
+
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(headers={'User-Agent': 'Mozilla/5.0'}, verify=False, timeout=10,
+                                     follow_redirects=True, limits=limits) as client:
+            workers = [asyncio.create_task(worker(client)) for _ in range(concurrency)]
+            if discover:
+                try: await discover_site(client)
+                except Exception as e: print(f"Discovery failed, falling back to link-following: {e}")
+            await frontier.join()
+            for w in workers: w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        if on_response and budget_skipped: await asyncio.to_thread(self.manifest.touch_many, budget_skipped)
+        if stats is not None: stats["budget_skipped"] = len(budget_skipped)
+        print(f"🔗 Crawled {fetched} URLs; collapsed {len(variants) - len(visited)} duplicate URL variants.")
+        if budget_skipped: print(f"⚠️ Page budget of {MAX_PAGES_TO_CRAWL} reached; {len(budget_skipped)} queued URLs not fetched.")
         return list(found_pages), list(found_pdfs)
 
     def _extract_text_from_pdf(self, pdf_bytes):
-        try:
-            reader = PdfReader(io.BytesIO(pdf_bytes))
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
-            return text
-        except:
-            return ""
+        return extract_pdf_text(pdf_bytes)[0]
 
     def _process_content(self, url, ctype, content):
-        tag = "[GENERAL]"
-        if "statistics" in url: tag = "[MARKET_DATA]"
-        if ctype == "pdf":
-            text = self._extract_text_from_pdf(content)
-        else:
-            soup = BeautifulSoup(content, 'html.parser')
-            text = soup.get_text(separator="\n")
-        return f"{tag} SOURCE: {url}\n\n{text.strip()}"
+        return parse_document(url, ctype, content)[0]
 
     def clean_text_chunk(self, text):
         text = re.sub(r'\s+', ' ', text)
@@ -5652,5 +7631,6 @@ Flexibility: Implement various strategies to profit in different market conditio
         while start < len(text):
             end = min(start + chunk_size, len(text))
             chunks.append(text[start:end])
+            if end == len(text): break
             start = end - overlap
         return chunks
\ No newline at end of file
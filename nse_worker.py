@@ -0,0 +1,111 @@
+import os
+import time
+import traceback
+import uuid
+from nse_engine import (NSEKnowledgeBase, RefreshCoordinator, RedisRefreshCoordinator, RefreshScheduler, RedisCacheBackend, MemoryCacheBackend,
+                        REFRESH_FRESHNESS_SECONDS, DATA_DIR, DATA_DIR_ID_PATH)
+
+# Ingestion worker: claims refresh jobs the API enqueued and runs them here, so crawling, parsing and
+# embedding never share a process (or a GIL) with /ask.
+# Run with: python -m nse_worker
+
+WORKER_POLL_SECONDS = 5
+
+
+def make_coordinator():
+    # Redis when configured, so the API and worker can run as separate services; otherwise the SQLite file.
+    # Either way both must mount the same DATA_DIR (see check_shared_data_dir).
+    redis_url = os.getenv("REDIS_URL")
+    freshness = float(os.getenv("REFRESH_FRESHNESS_SECONDS", REFRESH_FRESHNESS_SECONDS))
+    if redis_url: return RedisRefreshCoordinator(redis_url, freshness_seconds=freshness)
+    return RefreshCoordinator(freshness_seconds=freshness)
+
+
+def make_cache_backend():
+    # The worker invalidates the answer cache after a refresh, so it must bump the generation the API reads:
+    # in Redis when configured, otherwise in the SQLite file both processes share through DATA_DIR.
+    redis_url = os.getenv("REDIS_URL")
+    return RedisCacheBackend(redis_url) if redis_url else MemoryCacheBackend()
+
+
+def check_shared_data_dir(key="nse:data_dir"):
+    """Fails fast when the API and the worker run against different data directories.
+
+    The keyword index, manifest and embedding cache are local SQLite files, so a worker on another disk
+    would refresh Pinecone while the API keeps serving keyword hits from a stale index. Each data directory
+    gets a random id on first use; the first process to start publishes it to Redis and the other must match."""
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url: return  # the job queue is itself a file in DATA_DIR, so the processes already share it
+    import redis
+    try:
+        with open(DATA_DIR_ID_PATH, "x") as f: f.write(uuid.uuid4().hex)
+    except FileExistsError:
+        pass
+    with open(DATA_DIR_ID_PATH) as f: local_id = f.read().strip()
+    client = redis.Redis.from_url(redis_url)
+    client.set(key, local_id, nx=True)
+    shared_id = client.get(key).decode()
+    if shared_id != local_id:
+        raise RuntimeError(
+            f"NSE_DATA_DIR ({DATA_DIR}) is not the data directory the other NSE process uses. The API and the ingestion "
+            f"worker must mount the same volume; if it was replaced on purpose, delete the Redis key '{key}'."
+        )
+
+
+class IngestionWorker:
+    def __init__(self, engine, coordinator, scheduler=None, poll_seconds=WORKER_POLL_SECONDS):
+        self.engine = engine
+        self.coordinator = coordinator
+        self.scheduler = scheduler
+        self.poll_seconds = poll_seconds
+
+    def run_job(self, job):
+        print(f"⚙️ Running {job['scope']} refresh {job['id']}...")
+        if job["scope"] == "sources":
+            build = lambda progress: self.engine.refresh_sources(job["params"].get("urls", []), progress=progress)
+        else:
+            build = lambda progress: self.engine.build_knowledge_base(force=job["force"], progress=progress)
+        try:
+            finished = self.coordinator.run(job["id"], build)
+            print(f"✅ Refresh {job['id']} done: {finished['message']}")
+            return finished
+        except Exception as e:
+            print(f"❌ Refresh {job['id']} failed: {e}")
+            traceback.print_exc()
+            return self.coordinator.get(job["id"])
+
+    def run_pending(self):
+        finished = []
+        while True:
+            job = self.coordinator.claim()
+            if not job: return finished
+            finished.append(self.run_job(job))
+
+    def run_forever(self):
+        next_tick = time.monotonic()
+        while True:
+            if self.scheduler and time.monotonic() >= next_tick:
+                try: self.scheduler.tick()
+                except Exception as e: print(f"Scheduled refresh failed: {e}")
+                next_tick = time.monotonic() + self.scheduler.tick_seconds
+            if not self.run_pending():
+                time.sleep(self.poll_seconds)
+
+
+def main():
+    openai_key = os.getenv("OPENAI_API_KEY")
+    pinecone_key = os.getenv("PINECONE_API_KEY")
+    if not openai_key or not pinecone_key:
+        print("Error: Please set OPENAI_API_KEY and PINECONE_API_KEY environment variables.")
+        return
+
+    print("🚀 Initializing NSE ingestion worker...")
+    check_shared_data_dir()
+    engine = NSEKnowledgeBase(openai_api_key=openai_key, pinecone_api_key=pinecone_key, cache_backend=make_cache_backend())
+    coordinator = make_coordinator()
+    scheduler = None if os.getenv("REFRESH_SCHEDULER", "on").lower() == "off" else RefreshScheduler(engine, coordinator)
+    IngestionWorker(engine, coordinator, scheduler).run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import os
+import sys
 from nse_engine import NSEKnowledgeBase
+from nse_worker import IngestionWorker, make_coordinator, make_cache_backend, check_shared_data_dir, main as run_worker
 from dotenv import load_dotenv
 
 # Load environment variables from .env file if you have one, 
@@ -7,6 +9,26 @@ from dotenv import load_dotenv
 load_dotenv()
 
 def main():
+    # `python populate_db.py --worker` runs the long-lived ingestion worker instead of a one-off build
+    if "--worker" in sys.argv:
+        run_worker()
+        return
+
+    # `python populate_db.py --reconcile` deletes vectors the manifest doesn't track (e.g. from before it existed)
+    if "--reconcile" in sys.argv:
+        openai_key = os.getenv("OPENAI_API_KEY")
+        pinecone_key = os.getenv("PINECONE_API_KEY")
+        if not openai_key or not pinecone_key:
+            print("Error: Please set OPENAI_API_KEY and PINECONE_API_KEY environment variables.")
+            return
+        check_shared_data_dir()
+        active = make_coordinator().status()["active"]
+        if active:
+            print(f"Error: Refresh {active['id']} is {active['status']}; reconcile once it has finished.")
+            return
+        NSEKnowledgeBase(openai_api_key=openai_key, pinecone_api_key=pinecone_key).reconcile_untracked_vectors()
+        return
+
     # 1. Get API Keys
     openai_key = os.getenv("OPENAI_API_KEY")
     pinecone_key = os.getenv("PINECONE_API_KEY")
@@ -19,16 +41,22 @@ def main():
     try:
         # Initialize the engine
         # This will connect to Pinecone and OpenAI
-        engine = NSEKnowledgeBase(openai_api_key=openai_key, pinecone_api_key=pinecone_key)
+        check_shared_data_dir()
+        engine = NSEKnowledgeBase(openai_api_key=openai_key, pinecone_api_key=pinecone_key, cache_backend=make_cache_backend())
         
         print("🕷️ Starting the scraping and indexing process...")
         print("This may take a few minutes. Please wait...")
         
-        # Trigger the build process
-        status_message, logs = engine.build_knowledge_base()
+        # Queue a forced rebuild and run it here, unless a worker is already running one
+        coordinator = make_coordinator()
+        job, created = coordinator.trigger(force=True)
+        finished = IngestionWorker(engine, coordinator).run_pending()
+        if not finished:
+            print(f"\nℹ️ Refresh {job['id']} is already {job['status']} in another worker.")
+            return
         
         print("\n✅ Process Completed!")
-        print(f"Status: {status_message}")
+        print(f"Status: {finished[-1]['message']}")
         
         # Optional: Print logs if you want to see details
         # print("\n--- Detailed Logs ---")
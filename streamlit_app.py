@@ -1,5 +1,6 @@
 import streamlit as st
 import requests
+import json
 import time
 import base64
 import os
@@ -167,19 +168,34 @@ if not openai_api_key:
     st.stop()
 
 # --- API CONNECTION FUNCTION ---
-def query_api(user_query):
+def stream_api(user_query, meta):
+    """Yields answer tokens from the SSE endpoint; sources, errors and timing are written into `meta`."""
     try:
-        response = requests.post(
-            f"{api_url}/ask", 
+        with requests.post(
+            f"{api_url}/ask/stream",
             json={"query": user_query},
+            stream=True,
             timeout=60
-        )
-        response.raise_for_status()
-        return response.json()
+        ) as response:
+            response.raise_for_status()
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):].strip())
+                    if event == "sources":
+                        meta["sources"] = data.get("sources", [])
+                    elif event == "token":
+                        yield data.get("delta", "")
+                    elif event == "error":
+                        meta["error"] = f"System Error: {data.get('detail')}"
+                    elif event == "done":
+                        meta["done"] = data
     except requests.exceptions.ConnectionError:
-        return {"error": "Backend unavailable. The system might be updating or offline."}
+        meta["error"] = "Backend unavailable. The system might be updating or offline."
     except Exception as e:
-        return {"error": f"System Error: {str(e)}"}
+        meta["error"] = f"System Error: {str(e)}"
 
 # --- CHAT LOGIC ---
 if "messages" not in st.session_state:
@@ -195,21 +211,20 @@ if prompt := st.chat_input("Ask about the market..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant", avatar="https://i.postimg.cc/NF1qzmFV/nse-small-logo.png"):
-        with st.spinner("Analyzing market data..."):
-            result = query_api(prompt)
-            
-            if "error" in result:
-                st.error(result["error"])
-                st.session_state.messages.append({"role": "assistant", "content": result["error"]})
+        meta = {}
+        # Tokens render as they arrive instead of after the full answer is generated
+        answer = st.write_stream(stream_api(prompt, meta)) or ""
+
+        if "error" in meta:
+            st.error(meta["error"])
+            st.session_state.messages.append({"role": "assistant", "content": f"{answer}\n\n{meta['error']}" if answer else meta["error"]})
+        else:
+            sources = meta.get("sources", [])
+
+            full_response = answer
+            if sources:
+                source_text = "\n\n**Sources:** \n" + "  \n".join([f"• [{s.replace('https://www.nse.co.ke', 'nse.co.ke').split('/')[-1]}]({s})" for s in sources])
+                st.markdown(source_text)
+                st.session_state.messages.append({"role": "assistant", "content": full_response + source_text})
             else:
-                answer = result.get("answer", "No response.")
-                sources = result.get("sources", [])
-                
-                full_response = answer
-                if sources:
-                    source_text = "\n\n**Sources:** \n" + "  \n".join([f"• [{s.replace('https://www.nse.co.ke', 'nse.co.ke').split('/')[-1]}]({s})" for s in sources])
-                    st.markdown(full_response + source_text)
-                    st.session_state.messages.append({"role": "assistant", "content": full_response + source_text})
-                else:
-                    st.markdown(full_response)
-                    st.session_state.messages.append({"role": "assistant", "content": full_response})
\ No newline at end of file
+                st.session_state.messages.append({"role": "assistant", "content": full_response})
\ No newline at end of file
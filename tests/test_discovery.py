@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from nse_engine import NSEKnowledgeBase, IngestManifest, canonicalize_url
+
+LASTMOD = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - 3600))
+
+
+class Site(BaseHTTPRequestHandler):
+    def do_GET(self):
+        port = self.server.server_port
+        if self.path.startswith("/wp-sitemap.xml"):
+            urls = "".join(f"<url><loc>http://127.0.0.1:{port}/page-{n}/</loc><lastmod>{LASTMOD}</lastmod></url>" for n in range(2))
+            body, ctype = f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'.encode(), "application/xml"
+        elif self.path == "/" or self.path.startswith("/page-"):
+            body, ctype = b"<p>page</p>", "text/html"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Site)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_sitemap_skips_only_pages_ingested_since_lastmod(site, tmp_path):
+    engine = object.__new__(NSEKnowledgeBase)
+    engine.manifest = IngestManifest(str(tmp_path / "manifest.sqlite3"))
+    ingested, failed = (canonicalize_url(f"http://{site}/page-{n}/") for n in range(2))
+    engine.manifest.record(ingested, None, None, "hash", ["a"], "html")
+    # Ingested before the lastmod; a later refresh touched it and then failed to re-ingest.
+    engine.manifest.record(failed, None, None, "hash", ["b"], "html")
+    engine.manifest.conn.execute("UPDATE documents SET ingested_at = ? WHERE url = ?", (time.time() - 7200, failed))
+    engine.manifest.conn.commit()
+    started, fetched = time.time(), []
+    asyncio.run(engine.crawl_site_async([f"http://{site}/"], site, delay=0, on_response=lambda item: fetched.append(item[0])))
+    assert ingested not in fetched
+    assert failed in fetched
+    assert engine.manifest.get(ingested)["seen_at"] >= started
@@ -0,0 +1,46 @@
+import pytest
+
+from nse_engine import NSEKnowledgeBase
+
+
+@pytest.fixture(scope="module")
+def lookup():
+    # Only the fact-sheet index is needed; no API clients.
+    engine = object.__new__(NSEKnowledgeBase)
+    engine._build_fact_index()
+    return engine.fact_lookup
+
+
+@pytest.mark.parametrize("query", [
+    "What is the ticker for Safaricom?",
+    "What is the tick size for equities priced at KES 50?",
+    "What are the fees for options on futures?",
+    "What are the NSE trading hours?",
+])
+def test_answers_single_intent_questions(lookup, query):
+    assert lookup.lookup(query) is not None
+
+
+def test_ticker_answer(lookup):
+    answer, _ = lookup.lookup("What is the ticker for Safaricom?")
+    assert "SCOM" in answer
+
+
+@pytest.mark.parametrize("query", [
+    # Asset class the tick table doesn't cover
+    "tick size for bonds",
+    # Two questions in one; a ticker-only answer would drop the price
+    "What is the ticker for Safaricom and its closing price?",
+    # Broker commission is not in the derivatives market-fee tables
+    "commission a broker charges for options",
+    # Holiday schedule is not in the weekday session list
+    "Is the market open on public holidays?",
+    # Advice or opinion, not a lookup
+    "is SCOM a good ticker to buy?",
+    "Should I invest in the stock with ticker EQTY?",
+    # A related company, not the one whose ticker the table lists
+    "What is the ticker for Safaricom's parent Vodacom?",
+    "What is the ticker of the subsidiary of KCB Group?",
+])
+def test_falls_through_when_not_fully_covered(lookup, query):
+    assert lookup.lookup(query) is None
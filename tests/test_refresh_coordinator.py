@@ -0,0 +1,77 @@
+import fakeredis
+import pytest
+
+from nse_engine import RefreshCoordinator, RedisRefreshCoordinator
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_coordinator(server):
+    coordinator = RedisRefreshCoordinator("redis://localhost:6379/0")
+    coordinator.redis = fakeredis.FakeRedis(server=server)
+    return coordinator
+
+
+@pytest.fixture
+def sqlite_coordinator(tmp_path):
+    return RefreshCoordinator(str(tmp_path / "jobs.sqlite3"))
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def coordinator(request):
+    return request.getfixturevalue(f"{request.param}_coordinator")
+
+
+def test_triggers_merge_into_the_active_job(coordinator):
+    job, created = coordinator.trigger()
+    again, created_again = coordinator.trigger(force=True)
+    assert created and not created_again
+    assert again["id"] == job["id"]
+
+
+def test_late_heartbeat_does_not_reopen_a_finished_job(coordinator):
+    job, _ = coordinator.trigger()
+    coordinator.claim()
+    coordinator._set(job["id"], status="done", finished_at=1.0, message="ok")
+    coordinator.heartbeat(job["id"], {"stage": "ingesting"})
+    finished = coordinator.get(job["id"])
+    assert finished["status"] == "done"
+    assert finished["progress"] == {}
+    assert coordinator.status()["active"] is None
+
+
+def test_run_marks_job_done_and_releases_the_lock(coordinator):
+    job, _ = coordinator.trigger()
+    coordinator.claim()
+    finished = coordinator.run(job["id"], lambda progress: ("rebuilt", 3))
+    assert finished["status"] == "done"
+    assert coordinator.status()["last_finished"]["id"] == job["id"]
+    assert coordinator.trigger(force=True)[1]
+
+
+def test_heartbeat_racing_completion_loses(redis_coordinator, server):
+    # The heartbeat reads the job while it is running; the worker marks it done before the heartbeat
+    # writes back. WATCH must abort the stale write and the retry must see the terminal status.
+    job, _ = redis_coordinator.trigger()
+    redis_coordinator.claim()
+    other = RedisRefreshCoordinator("redis://localhost:6379/0")
+    other.redis = fakeredis.FakeRedis(server=server)
+    get = redis_coordinator.get
+    raced = []
+
+    def racing_get(job_id, client=None):
+        current = get(job_id, client)
+        if not raced:
+            raced.append(True)
+            other._set(job_id, status="done", finished_at=1.0, message="ok")
+        return current
+
+    redis_coordinator.get = racing_get
+    redis_coordinator.heartbeat(job["id"], {"stage": "ingesting"})
+    assert raced
+    assert other.get(job["id"])["status"] == "done"
+    assert other.redis.get(other.active_key) is None
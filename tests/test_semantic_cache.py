@@ -0,0 +1,89 @@
+import fakeredis
+import numpy as np
+import pytest
+
+from nse_engine import MemoryCacheBackend, RedisCacheBackend, SemanticCache
+
+
+def embedding(seed):
+    return np.random.default_rng(seed).standard_normal(8).astype(np.float32)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def redis_backend(server, **kwargs):
+    backend = RedisCacheBackend("redis://localhost:6379/0", **kwargs)
+    backend.redis = fakeredis.FakeRedis(server=server)
+    return backend
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request, tmp_path, server):
+    if request.param == "memory": return MemoryCacheBackend(generation_path=str(tmp_path / "jobs.sqlite3"))
+    return redis_backend(server)
+
+
+def test_hit_and_miss(backend):
+    cache = SemanticCache(backend)
+    cache.store("trading hours?", embedding(1), "9:30 to 15:00", ["https://nse.co.ke"], cache.generation())
+    assert cache.lookup(embedding(1)) == ("9:30 to 15:00", ["https://nse.co.ke"])
+    assert cache.lookup(embedding(2)) is None
+
+
+def test_entries_stored_after_a_lookup_are_picked_up(backend):
+    cache = SemanticCache(backend)
+    assert cache.lookup(embedding(1)) is None
+    cache.store("trading hours?", embedding(1), "9:30 to 15:00", [], cache.generation())
+    assert cache.lookup(embedding(1))
+
+
+def test_only_new_entries_are_fetched(backend):
+    cache = SemanticCache(backend)
+    for i in range(5): cache.store(f"q{i}", embedding(i), f"a{i}", [], cache.generation())
+    cache.lookup(embedding(0))
+    assert backend.entries_since(cache.generation(), cache.cursor)[0] == []
+    assert len(cache.keys) == 5
+
+
+def test_invalidate_drops_mirrored_entries(backend):
+    cache = SemanticCache(backend)
+    cache.store("trading hours?", embedding(1), "9:30 to 15:00", [], cache.generation())
+    assert cache.lookup(embedding(1))
+    cache.invalidate()
+    assert cache.lookup(embedding(1)) is None
+
+
+def test_expired_entries_are_skipped(backend):
+    cache = SemanticCache(backend, ttl=-1)
+    cache.store("trading hours?", embedding(1), "9:30 to 15:00", [], cache.generation())
+    assert cache.lookup(embedding(1)) is None
+
+
+def test_evicted_entry_falls_through(server):
+    backend = redis_backend(server, max_entries=1)
+    cache = SemanticCache(backend)
+    cache.store("trading hours?", embedding(1), "9:30 to 15:00", [], cache.generation())
+    assert cache.lookup(embedding(1))
+    cache.store("settlement?", embedding(2), "T+3", [], cache.generation())
+    assert cache.lookup(embedding(1)) is None
+    assert cache.lookup(embedding(2)) == ("T+3", [])
+
+
+def test_other_api_worker_sees_stored_answers(server):
+    first, second = SemanticCache(redis_backend(server)), SemanticCache(redis_backend(server))
+    second.lookup(embedding(1))
+    first.store("trading hours?", embedding(1), "9:30 to 15:00", [], first.generation())
+    assert second.lookup(embedding(1))
+
+
+def test_refresh_in_another_process_invalidates_memory_cache(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    api = SemanticCache(MemoryCacheBackend(generation_path=path))
+    worker = SemanticCache(MemoryCacheBackend(generation_path=path))
+    api.store("trading hours?", embedding(1), "9:30 to 15:00", ["https://nse.co.ke"], api.generation())
+    assert api.lookup(embedding(1))
+    worker.invalidate()
+    assert api.lookup(embedding(1)) is None
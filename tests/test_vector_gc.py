@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import nse_engine
+from nse_engine import NSEKnowledgeBase, IngestManifest, KeywordIndex, LocalVectorIndex, canonicalize_url
+
+
+class FlakyIndex(LocalVectorIndex):
+    def __init__(self):
+        super().__init__()
+        self.fail_deletes = True
+
+    def delete(self, ids):
+        if self.fail_deletes: raise RuntimeError("pinecone unavailable")
+        super().delete(ids)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = object.__new__(NSEKnowledgeBase)
+    engine.index = FlakyIndex()
+    engine.manifest = IngestManifest(str(tmp_path / "manifest.sqlite3"))
+    engine.keyword_index = KeywordIndex(str(tmp_path / "keywords.sqlite3"))
+    engine.index.upsert([{"id": "doc#0", "values": [1.0, 0.0], "metadata": {}}])
+    engine.keyword_index.upsert([("doc#0", "https://nse.co.ke/doc", "settlement cycle")])
+    engine.manifest.record("https://nse.co.ke/doc", None, None, "hash", ["doc#0"])
+    return engine
+
+
+def test_failed_vector_delete_keeps_manifest_and_keywords(engine):
+    assert engine.remove_document("https://nse.co.ke/doc", ["doc#0"]) is False
+    assert engine.manifest.get("https://nse.co.ke/doc") is not None
+    assert engine.keyword_index.search("settlement")
+
+
+def test_retry_after_failure_removes_everything(engine):
+    engine.remove_document("https://nse.co.ke/doc", ["doc#0"])
+    engine.index.fail_deletes = False
+    assert engine.remove_document("https://nse.co.ke/doc", ["doc#0"]) is True
+    assert engine.manifest.get("https://nse.co.ke/doc") is None
+    assert "doc#0" not in engine.index.vectors
+    assert not engine.keyword_index.search("settlement")
+
+
+def test_reconcile_deletes_only_untracked_vectors(engine):
+    engine.index.fail_deletes = False
+    engine.index.upsert([{"id": "legacy#0", "values": [0.0, 1.0], "metadata": {}}])
+    assert engine.reconcile_untracked_vectors() == 1
+    assert set(engine.index.vectors) == {"doc#0"}
+
+
+def test_reconcile_refuses_empty_manifest(engine):
+    engine.index.fail_deletes = False
+    engine.manifest.delete("https://nse.co.ke/doc")
+    assert engine.reconcile_untracked_vectors() == 0
+    assert "doc#0" in engine.index.vectors
+
+
+class Site(BaseHTTPRequestHandler):
+    # Page n links to pages n+1 and n+2, so the frontier outgrows any small budget.
+    def do_GET(self):
+        n = int(self.path.strip("/").split("-")[-1] or 0)
+        body = f'<a href="/page-{n + 1}/">next</a><a href="/page-{n + 2}/">skip</a>'.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_pages_skipped_for_budget_are_not_swept(engine, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Site)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    domain = f"127.0.0.1:{server.server_port}"
+    for n in range(1, 6): engine.manifest.record(canonicalize_url(f"http://{domain}/page-{n}/"), None, None, "hash", [f"p{n}"])
+    monkeypatch.setattr(nse_engine, "MAX_PAGES_TO_CRAWL", 3)
+    started, stats = time.time(), {}
+    try:
+        asyncio.run(engine.crawl_site_async([f"http://{domain}/page-0/"], domain, delay=0, discover=False,
+                                            on_response=lambda item: engine.manifest.touch(item[0]), stats=stats))
+    finally:
+        server.shutdown()
+    assert stats["budget_skipped"] > 0
+    unseen = {d["url"] for d in engine.manifest.unseen_since(started)}
+    assert canonicalize_url(f"http://{domain}/page-4/") not in unseen
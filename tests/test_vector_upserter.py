@@ -0,0 +1,52 @@
+import nse_engine
+from nse_engine import LocalIndexError, LocalVectorIndex, VectorUpserter
+
+
+def vectors(n, dims=8, prefix="v"):
+    return [{"id": f"{prefix}{i}", "values": [0.1] * dims, "metadata": {"text": "x" * 100}} for i in range(n)]
+
+
+class DownIndex(LocalVectorIndex):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def upsert(self, vectors):
+        self.calls += 1
+        raise LocalIndexError(503, "Service Unavailable")
+
+
+def test_oversized_requests_are_split():
+    index = LocalVectorIndex(max_request_bytes=4000)
+    upserter = VectorUpserter(index, target_bytes=50000, backoff=0)
+    upserter.add(vectors(100))
+    assert upserter.close() == 100
+    assert len(index.vectors) == 100
+    assert not upserter.failed_ids
+
+
+def test_vector_too_large_on_its_own_fails_alone():
+    index = LocalVectorIndex(max_request_bytes=4000)
+    upserter = VectorUpserter(index, target_bytes=50000, backoff=0)
+    upserter.add(vectors(20) + vectors(1, dims=1000, prefix="huge"))
+    assert upserter.close() == 20
+    assert upserter.failed_ids == {"huge0"}
+
+
+def test_rate_limited_batches_back_off_and_land(monkeypatch):
+    monkeypatch.setattr(nse_engine, "UPSERT_MAX_RETRIES", 30)
+    index = LocalVectorIndex(requests_per_second=4)
+    upserter = VectorUpserter(index, max_vectors=10, workers=4, backoff=0.05)
+    upserter.add(vectors(100))
+    assert upserter.close() == 100
+    assert index.rejected > 0
+    assert not upserter.failed_ids
+
+
+def test_outage_fails_whole_batches_without_splitting():
+    index = DownIndex()
+    upserter = VectorUpserter(index, max_vectors=100, backoff=0)
+    upserter.add(vectors(200))
+    assert upserter.close() == 0
+    assert index.calls == 2 * nse_engine.UPSERT_MAX_RETRIES
+    assert upserter.failed_ids == {f"v{i}" for i in range(200)}